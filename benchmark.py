@@ -0,0 +1,263 @@
+"""
+ Benchmarks of pygroup on synthetic populations
+
+ Copyright (C) 2014,  Oscar Dowson
+
+ A seeded population is written as classification and entity data files, and as an equivalent SQLite database.
+ Each model is then timed phase by phase (data load, model build, MPS file write, solve and extraction) and the
+ results are saved as JSON. Comparing with the JSON of an earlier version shows the phases that got slower, e.g.
+
+    python benchmark.py --entities 5000 --groups 10 --output new.json --baseline old.json
+"""
+import argparse
+import collections
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import pygroup
+
+
+def generate_population(directory, name, n_entities, n_numerical, n_categorical, n_levels, seed):
+    """
+    Writes a synthetic population as tab-delimited classification and entity data files.
+    Numerical variables are normal with a random mean and standard deviation, and the levels of categorical
+    variables have random proportions
+    :param directory: directory to write the files to
+    :param name: name of the population, used in the file names
+    :param n_entities: number of entities
+    :param n_numerical: number of numerical variables
+    :param n_categorical: number of categorical variables
+    :param n_levels: number of levels of each categorical variable
+    :param seed: random seed
+    :return: tuple (classification filepath, entity filepath)
+    """
+
+    rng = random.Random(seed)
+
+    numerical = ['N%d' % (i + 1) for i in range(n_numerical)]
+    categorical = ['C%d' % (i + 1) for i in range(n_categorical)]
+
+    classification_file = os.path.join(directory, '%s_classification.txt' % name)
+    with open(classification_file, 'w') as f:
+        f.write('Variable\tIsCategorical\n')
+        for v in numerical:
+            f.write('%s\t0\n' % v)
+        for c in categorical:
+            f.write('%s\t1\n' % c)
+
+    # Mean and standard deviation of each numerical variable
+    moments = [(rng.uniform(10, 100), rng.uniform(1, 20)) for v in numerical]
+
+    # Cumulative proportions of the levels of each categorical variable
+    cumulative = list()
+    for c in categorical:
+        weights = [rng.uniform(1, 10) for l in range(n_levels)]
+        cumulative.append([sum(weights[:l + 1]) / sum(weights) for l in range(n_levels)])
+
+    entity_file = os.path.join(directory, '%s_entity_data.txt' % name)
+    with open(entity_file, 'w') as f:
+        f.write('\t'.join(['ID'] + numerical + categorical) + '\n')
+        for e in range(n_entities):
+            row = ['E%07d' % (e + 1)]
+            row += ['%.3f' % rng.gauss(u, sd) for (u, sd) in moments]
+            for levels in cumulative:
+                r = rng.random()
+                row.append('L%d' % len([p for p in levels[:-1] if p < r]))
+            f.write('\t'.join(row) + '\n')
+
+    return classification_file, entity_file
+
+
+def write_database(filename, classification_file, entity_file):
+    """
+    Writes the files of a population to an SQLite database, with the tables classification(Variable,
+    IsCategorical) and entity_data(ID, ...) that DataBase reads
+    :param filename: full filepath of the database
+    :param classification_file: full filepath of classification file
+    :param entity_file: full filepath of entity data file
+    :return:
+    """
+
+    if os.path.exists(filename):
+        os.remove(filename)
+
+    with open(classification_file, 'r') as f:
+        f.readline()
+        classification = [line.split() for line in f if line.strip()]
+    is_categorical = dict([(v, int(k)) for (v, k) in classification])
+
+    con = sqlite3.connect(filename)
+    try:
+        con.execute('CREATE TABLE classification (Variable TEXT, IsCategorical INTEGER)')
+        con.executemany('INSERT INTO classification VALUES (?, ?)', [(v, int(k)) for (v, k) in classification])
+
+        with open(entity_file, 'r') as f:
+            header = f.readline().rstrip('\n').split('\t')
+            types = ['TEXT' if v == 'ID' or is_categorical[v] else 'REAL' for v in header]
+            columns = ', '.join(['%s %s' % (v, t) for (v, t) in zip(header, types)])
+            con.execute('CREATE TABLE entity_data (%s)' % columns)
+            con.executemany('INSERT INTO entity_data VALUES (%s)' % ', '.join(['?'] * len(header)),
+                            (line.rstrip('\n').split('\t') for line in f))
+        con.commit()
+    finally:
+        con.close()
+
+    return
+
+
+def load(source, files):
+    """
+    Loads a population
+    :param source: 'flat' for the files or 'sqlite' for the database
+    :param files: tuple (classification filepath, entity filepath, database filepath)
+    :return: data class
+    """
+
+    classification_file, entity_file, database_file = files
+    if source == 'flat':
+        return pygroup.FlatFile(classification_file, entity_file)
+    return pygroup.DataBase(None, database_file, 'entity_data', 'classification', driver=sqlite3)
+
+
+def run_model(model_name, source, population, target, args):
+    """
+    Times each phase of building and solving a model
+    :param model_name: name of a model class of pygroup
+    :param source: 'flat' or 'sqlite'
+    :param population: files of the population to partition, or to select from
+    :param target: files of the population to match, for the distribution models
+    :param args: command line arguments
+    :return: dictionary of results
+    """
+
+    result = collections.OrderedDict([('model', model_name), ('source', source)])
+    model_class = getattr(pygroup, model_name)
+
+    start = time.time()
+    data = load(source, population)
+    if 'Distribution' in model_name:
+        target_data = load(source, target)
+    result['load'] = time.time() - start
+
+    start = time.time()
+    if 'Distribution' in model_name:
+        model = model_class(target_data, data, args.people or max(args.entities / 10, 1))
+    else:
+        model = model_class(data, args.groups)
+    result['build'] = time.time() - start
+
+    directory = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        mps_file = os.path.join(directory, 'model.mps')
+        model.write_mps(mps_file)
+        result['write'] = time.time() - start
+
+        start = time.time()
+        status, objective, values = pygroup.CBC().solve(mps_file, args.time_limit, directory, stats=model.stats)
+        result['solve'] = time.time() - start
+
+        start = time.time()
+        model.set_solver_solution(status, values)
+        model.process_solution()
+        result['extract'] = time.time() - start
+    finally:
+        shutil.rmtree(directory)
+
+    # Size of the model, outcome of the solver, and the time and memory of the phases of the load and build
+    result['size'] = model.get_size()
+    result['solver'] = model.stats.solver
+    result['phases'] = collections.OrderedDict([(s.name, s.phases) for s in [data.stats, model.stats]])
+
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints the phases that are slower than in a baseline
+    :param results: list of results
+    :param baseline: results of an earlier run, as saved by this script
+    :param tolerance: ratio of times above which a phase is reported
+    :return: number of phases slower than the tolerance
+    """
+
+    earlier = dict([((r['model'], r['source']), r) for r in baseline['results']])
+
+    slower = 0
+    for result in results:
+        key = (result['model'], result['source'])
+        if key not in earlier:
+            continue
+        for phase in ['load', 'build', 'write', 'solve', 'extract']:
+            # Phases under 10ms are too noisy to compare
+            ratio = result[phase] / max(earlier[key][phase], 0.01)
+            if ratio > tolerance:
+                print '%s (%s) %s: %.3fs, was %.3fs' % (key[0], key[1], phase, result[phase], earlier[key][phase])
+                slower += 1
+
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of pygroup on synthetic populations')
+    parser.add_argument('--entities', type=int, default=1000, help='number of entities')
+    parser.add_argument('--numerical', type=int, default=2, help='number of numerical variables')
+    parser.add_argument('--categorical', type=int, default=3, help='number of categorical variables')
+    parser.add_argument('--levels', type=int, default=4, help='number of levels of each categorical variable')
+    parser.add_argument('--groups', type=int, default=4, help='number of groups to partition into')
+    parser.add_argument('--people', type=int, default=None,
+                        help='number of entities to select (default a tenth of the entities)')
+    parser.add_argument('--seed', type=int, default=1, help='random seed of the population')
+    parser.add_argument('--time-limit', type=float, default=10, help='time limit of each solve (seconds)')
+    parser.add_argument('--models', nargs='+', help='model classes to run',
+                        default=['PartitionModel', 'MatrixPartitionModel', 'DistributionModel',
+                                 'MatrixDistributionModel'])
+    parser.add_argument('--sources', nargs='+', choices=['flat', 'sqlite'], default=['flat', 'sqlite'],
+                        help='data sources to load from')
+    parser.add_argument('--output', default='benchmark.json', help='file to save the results to')
+    parser.add_argument('--baseline', default=None, help='results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help='ratio of times above which a phase counts as slower than the baseline')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        # Population to partition or select from, and a second population for the distribution models to match
+        files = dict()
+        for name, seed in [('population', args.seed), ('target', args.seed + 1)]:
+            classification_file, entity_file = generate_population(directory, name, args.entities, args.numerical,
+                                                                   args.categorical, args.levels, seed)
+            database_file = os.path.join(directory, '%s.sqlite' % name)
+            write_database(database_file, classification_file, entity_file)
+            files[name] = (classification_file, entity_file, database_file)
+
+        results = list()
+        for model_name in args.models:
+            for source in args.sources:
+                results.append(run_model(model_name, source, files['population'], files['target'], args))
+                print ' '.join(['%s=%s' % (k, '%.3f' % a if isinstance(a, float) else a)
+                                for (k, a) in results[-1].items() if k != 'phases'])
+    finally:
+        shutil.rmtree(directory)
+
+    parameters = dict([(k, a) for (k, a) in vars(args).items() if k not in ['output', 'baseline', 'tolerance']])
+    with open(args.output, 'w') as f:
+        json.dump({'parameters': parameters, 'python': platform.python_version(), 'date': time.ctime(),
+                   'results': results}, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            if compare(results, json.load(f), args.tolerance):
+                sys.exit(1)
+
+    return
+
+
+if __name__ == '__main__':
+    main()
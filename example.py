@@ -3,6 +3,7 @@
 
  Copyright (C) 2014,  Oscar Dowson
 """
+import time
 import pygroup
 
 # ====================================================================================================================
@@ -22,6 +23,9 @@ f_class = 'example_files/classification.txt'
 # Entity data
 data1 = pygroup.FlatFile(f_class, f_entity)
 
+# Large files that are loaded many times can be parsed once and then read from a cache directory, e.g.
+#   data1 = pygroup.FlatFile(f_class, f_entity, cache_directory='pygroup_cache')
+
 # number of groups to divide into
 n_groups = 2
 
@@ -37,6 +41,60 @@ allocation, quality = partition_model.solve(time_limit)
 print allocation
 print quality
 
+# Time and peak memory of each phase, the size of the model and the outcome of the solver. The phases are also
+# logged to the 'pygroup' logger, e.g. after logging.basicConfig(level=logging.INFO)
+print partition_model.stats.as_dict()
+
+# An earlier allocation (for example from a quick local search) can be used to warm start the solver
+allocation, quality = partition_model.solve(time_limit, initial=allocation['entity-group'])
+
+# Race several solver configurations at once and keep the best allocation (GLPK/HiGHS are skipped if not installed)
+portfolio = pygroup.Portfolio([pygroup.CBC(seed=1), pygroup.CBC(seed=2), pygroup.GLPK(), pygroup.HiGHS()])
+allocation, quality = partition_model.solve(time_limit, solver=portfolio)
+
+# Any allocation can be scored without solving a model
+quality = pygroup.QualityEvaluator(data1).get_partition_quality(allocation)
+
+# When a few entities join or leave, the model can be updated in place and solved again from the last allocation.
+# A disruption cost discourages moving the entities that were already allocated, e.g.
+#   partition_model.update_entities(pygroup.FlatFile(f_class, 'example_files/entity_data_new.txt'))
+#   allocation, quality = partition_model.resolve(time_limit, allocation['entity-group'], disruption=0.01)
+
+# Many independent problems, e.g. one per cohort, can be solved in a process pool, with results as they complete
+problems = [pygroup.Problem('cohort %d' % n, pygroup.PartitionModel, (data1, n), time_limit) for n in [2, 3]]
+for key, allocation, quality in pygroup.solve_many(problems, processes=2):
+    print key, allocation
+
+# Results can be kept in a cache directory, so solving the same data and model with the same arguments again
+# returns at once. cache.invalidate(partition_model.get_fingerprint(time_limit)) or cache.clear() removes them
+cache = pygroup.ResultCache('pygroup_results')
+allocation, quality = cache.solve(partition_model, time_limit)
+
+# A solve can also run in the background, e.g. in a service, and be cancelled, which kills the solver. The model
+# is only used again once the job is done
+job = partition_model.solve_async(time_limit)
+if not job.done():
+    job.cancel()
+try:
+    job.result()
+except pygroup.SolveCancelled:
+    pass
+
+# Its progress (incumbent objective, best bound, gap, nodes) can be followed as the solver reports it, and the solve
+# stopped early, which returns the best allocation found so far
+def print_progress(progress):
+    print 'Objective %(objective)s, bound %(bound)s, gap %(gap)s, %(nodes)s nodes' % progress
+
+
+job = partition_model.solve_async(time_limit, callback=print_progress)
+while not job.done():
+    gap = job.get_progress().get('gap')
+    if gap is not None and gap < 0.05:
+        job.stop()
+        break
+    time.sleep(1)
+allocation, quality = job.result()
+
 # ====================================================================================================================
 #
 #   Example 2:      Selecting a subset of a population to match the characteristics of another
@@ -79,9 +137,13 @@ class_tab = 'categories'
 # People in our `control' group
 data_a = pygroup.DataBase(server, database, entity_tab, class_tab, where='ID > 200')
 
-# People in our population to select out of
+# People in our population to select out of (this reuses the connection data_a was loaded with)
 data_b = pygroup.DataBase(server, database, entity_tab, class_tab, where='ID <= 200')
 
+# Other DB-API 2.0 modules can be used in place of pyodbc, e.g. for a copy of the tables in SQLite:
+#   import sqlite3
+#   data_a = pygroup.DataBase(None, 'enggen403.db', entity_tab, class_tab, where='ID > 200', driver=sqlite3)
+
 # Number of people to select
 n_people = 10
 
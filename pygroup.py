@@ -21,34 +21,329 @@
 
 """
 from pulp import *
-import pyodbc
+import array
+import collections
+import contextlib
 import csv
+import hashlib
+import logging
+import multiprocessing
+import numpy
+import os
+import pickle
+import random
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
 from pulp import solvers
 
+try:
+    import pyodbc
+except ImportError:
+    # Only needed by DataBase, when no other driver is given
+    pyodbc = None
+
+try:
+    import resource
+except ImportError:
+    # Not on Windows, where peak memory is not recorded
+    resource = None
+
+# Logger the phases of models and data loads are reported to
+logger = logging.getLogger('pygroup')
+
+
+class Stats(object):
+    """
+    Wall time and peak memory of each phase of a model or data load, with the size of the model and the outcome
+    of the solver.
+
+    Each phase is also logged to the 'pygroup' logger at INFO level as it ends, so a logging handler can follow
+    a long run. Peak memory is the high-water mark of the whole process (the solver runs in its own), in MB, at
+    the end of the phase, and the peak increase is how much it rose during the phase. Both are process-wide, so
+    phases running at the same time in other threads, e.g. background solves, count towards them.
+    """
+
+    def __init__(self, name):
+        """
+        Instantiate Stats
+        :param name: name of the model or data, used in the log
+        :return:
+        """
+
+        self.name = name
+
+        # dictionary[phase] = {'seconds': wall time, 'peak_memory': MB, 'peak_increase': MB}, in the order the
+        # phases ran
+        self.phases = collections.OrderedDict()
+
+        # Number of variables, constraints and non-zeros of the model last written for the solver
+        self.size = dict()
+
+        # Status, objective, best bound, relative gap and nodes of the last solve
+        self.solver = dict()
+
+        return
+
+    @contextlib.contextmanager
+    def phase(self, phase):
+        """
+        Records the wall time and peak memory of the code in a with block. A phase that runs again is replaced
+        :param phase: name of the phase
+        :return: context manager
+        """
+
+        # The process-wide peak is left alone, as other threads and tools may be watching it
+        before = self.get_peak_memory()
+        start = time.time()
+        try:
+            yield
+        finally:
+            peak = self.get_peak_memory()
+            increase = None if peak is None else peak - before
+            self.phases[phase] = {'seconds': time.time() - start, 'peak_memory': peak, 'peak_increase': increase}
+            logger.info('%s %s: %.3fs, peak memory %s', self.name, phase, self.phases[phase]['seconds'],
+                        'unknown' if peak is None else '%.1f MB (+%.1f MB)' % (peak, increase))
+
+    @staticmethod
+    def get_peak_memory():
+        """
+        Peak resident memory of the process
+        :return: MB, or None where it is not available
+        """
+
+        try:
+            with open('/proc/self/status', 'r') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) / 1024.0
+        except (IOError, OSError):
+            pass
+
+        if resource is None:
+            return None
+
+        # Kilobytes on Linux, bytes on Mac OS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024.0 / (1024.0 if sys.platform == 'darwin' else 1.0)
+
+    def set_outcome(self, status, objective, log):
+        """
+        Sets the outcome of a solve
+        :param status: PuLP status
+        :param objective: objective value, or None
+        :param log: dictionary of 'bound' and 'nodes' read from the solver log, where reported
+        :return:
+        """
+
+        bound = log.get('bound')
+        if bound is None and status == LpStatusOptimal:
+            bound = objective
+
+        self.solver = {'status': LpStatus[status], 'objective': objective, 'bound': bound,
+                       'gap': get_gap(objective, bound), 'nodes': log.get('nodes')}
+        logger.info('%s solver: %s', self.name, self.solver)
+
+        return
+
+    def as_dict(self):
+        """
+        All the statistics, e.g. to save as JSON
+        :return: dictionary
+        """
+        return {'name': self.name, 'phases': collections.OrderedDict(self.phases), 'size': dict(self.size),
+                'solver': dict(self.solver)}
+
+
+def get_gap(objective, bound):
+    """
+    Relative gap between an objective value and a bound on it
+    :param objective: objective value, or None
+    :param bound: bound, or None
+    :return: gap, or None if either is unknown or the objective is zero
+    """
+
+    if objective is None or bound is None or objective == 0:
+        return None
+    return abs(objective - bound) / abs(objective)
+
 
 class Model(object):
     
     def __init__(self, name):
         self.model = LpProblem(name, LpMinimize)
+
+        # Column names of the variables in the last MPS file written
+        self.column_names = None
+
+        # Time and memory of each phase, size of the model and outcome of the solver
+        self.stats = Stats(name)
         return
 
     @staticmethod
     def mean(x):
-        return sum(x) / float(len(x))
+        return Statistics(x).mean
 
     def var(self, x, u=None):
         if u is None:
-            u = self.mean(x)
+            return Statistics(x).get_var()
         return sum([pow(i - u, 2) for i in x]) / len(x)
 
-    def solve(self, time_limit):
+    def value(self, variable):
+        """
+        Value of a variable in the solution
+        :param variable: model variable
+        :return: value
+        """
+        return variable.value()
+
+    def set_value(self, variable, value):
+        """
+        Set the value of a variable, for solutions found without the solver
+        :param variable: model variable
+        :param value: value
+        :return:
+        """
+        variable.varValue = value
+        return
+
+    def solve(self, time_limit, initial=None, solver=None, job=None):
+        """
+        Solve the model
+        :param time_limit: time limit (seconds)
+        :param initial: allocation to warm start the solver from (optional)
+        :param solver: solver backend, e.g. CBC, GLPK, HiGHS or Portfolio (optional, default CBC)
+        :param job: SolveJob the solve runs in, which can stop the solver (optional)
+        :return: tuple (allocation, quality)
+        """
+
+        if solver is None:
+            solver = CBC()
+
+        directory = tempfile.mkdtemp()
         try:
-            # New PuLP needs this
-            self.model.solve(solvers.COIN_CMD(maxSeconds=time_limit))
-        except solvers.PulpSolverError:
-            # Old PuLP needs this
-            self.model.solve(solvers.PULP_CBC_CMD(maxSeconds=time_limit))
-        return self.process_solution()
+            with self.stats.phase('write'):
+                mps_file = os.path.join(directory, 'model.mps')
+                self.write_mps(mps_file)
+
+                mip_start_file = None
+                if initial is not None:
+                    # Pass the initial allocation to the solver as a MIP start
+                    self.set_allocation(initial)
+                    mip_start_file = os.path.join(directory, 'model.mst')
+                    self.write_mip_start(mip_start_file)
+
+            self.stats.size = self.get_size()
+
+            with self.stats.phase('solve'):
+                status, objective, values = solver.solve(mps_file, time_limit, directory, mip_start_file, job,
+                                                         self.stats)
+            with self.stats.phase('read solution'):
+                self.set_solver_solution(status, values)
+        finally:
+            shutil.rmtree(directory)
+
+        with self.stats.phase('process solution'):
+            return self.process_solution()
+
+    def get_size(self):
+        """
+        Size of the model as last written
+        :return: dictionary of the number of variables, constraints and non-zeros
+        """
+
+        constraints = self.model.constraints.values()
+        return {'variables': len(self.model.variables()), 'constraints': len(constraints),
+                'nonzeros': sum([len(c) for c in constraints])}
+
+    def solve_async(self, time_limit, executor=None, callback=None, **kwargs):
+        """
+        Solve the model in the background, without blocking the calling thread.
+        The model must not be changed or solved again until the job is done
+        :param time_limit: time limit (seconds)
+        :param executor: SolveExecutor that limits the solves running at once (optional, default the shared
+            solve_executor)
+        :param callback: function called with the progress of the solver as it changes, see SolveJob (optional)
+        :param kwargs: keyword arguments of solve, e.g. initial or solver
+        :return: SolveJob, whose result is the tuple (allocation, quality)
+        """
+        return (solve_executor if executor is None else executor).submit(self, time_limit, callback, **kwargs)
+
+    def get_key(self):
+        """
+        Data and parameters the solution of the model depends on
+        :return: list
+        """
+        raise NotImplementedError
+
+    def get_fingerprint(self, time_limit, **kwargs):
+        """
+        Key of a solve in a ResultCache: changes whenever the data, the model, the solver settings or the other
+        arguments of solve change
+        :param time_limit: time limit (seconds)
+        :param kwargs: keyword arguments of solve, e.g. initial or solver
+        :return: hex digest
+        """
+
+        solver = kwargs.pop('solver', None)
+        kwargs.pop('job', None)
+
+        # Dictionaries, e.g. an initial allocation, are sorted so equal arguments give the same key
+        arguments = [(k, sorted(a.items()) if isinstance(a, dict) else a) for (k, a) in sorted(kwargs.items())]
+        key = [type(self).__name__, self.get_key(), time_limit, (CBC() if solver is None else solver).get_key(),
+               arguments]
+
+        return hashlib.sha1(repr(key)).hexdigest()
+
+    def write_mps(self, filename):
+        """
+        Write the model to an MPS file, with the variables renamed to short column names
+        :param filename: full filepath of file
+        :return:
+        """
+
+        # dictionary[variable name] = column name
+        self.column_names = self.model.writeMPS(filename, rename=1)[1]
+
+        return
+
+    def write_mip_start(self, filename):
+        """
+        Write the values of the integer variables as a CBC MIP start file
+        :param filename: full filepath of file
+        :return:
+        """
+
+        with open(filename, 'w') as f:
+            i = 0
+            for variable in self.model.variables():
+                if variable.cat == LpInteger and variable.varValue is not None:
+                    f.write('%d %s %.12g\n' % (i, self.column_names[variable.name], variable.varValue))
+                    i += 1
+
+        return
+
+    def set_solver_solution(self, status, values):
+        """
+        Sets the variable values from a solution read from the solver
+        :param status: PuLP status
+        :param values: dictionary[column name] = value
+        :return:
+        """
+
+        self.model.status = status
+        self.model.assignVarsVals(dict([(n, values.get(self.column_names[n], 0.0)) for n in self.column_names]))
+
+        return
+
+    def set_allocation(self, allocation):
+        raise NotImplementedError
 
     def process_solution(self):
         raise NotImplementedError
@@ -56,51 +351,104 @@ class Model(object):
 
 class PartitionModel(Model):
 
-    def __init__(self, model_data, n_groups, name='PartitionModel'):
+    def __init__(self, model_data, n_groups, name='PartitionModel', symmetry_breaking=False, sizes=None,
+                 aggregate=False, resolution=None):
         """
 
         :param model_data: data class
         :param n_groups: number of groups to partition into
         :param name: model name (optional)
+        :param symmetry_breaking: if True, exclude allocations that only relabel groups of the same size (optional)
+        :param sizes: list of group sizes, in place of the near-equal sizes from create_groups (optional)
+        :param aggregate: if True, model equivalent entities as one class with an integer count per group (optional)
+        :param resolution: dictionary[numerical variable] = bucket width when aggregating (optional)
         :return:
         """
 
         # Inherits Model class
-        Model.__init__(self, name)
+        super(PartitionModel, self).__init__(name)
+
+        # Data of the entities being allocated
+        self.entity_data = model_data
+
+        # Options the model was built with
+        self.symmetry_breaking = symmetry_breaking
+        self.aggregate = aggregate
+        self.resolution = resolution
+
+        if aggregate:
+            # Equivalent entities are modelled as one class
+            model_data = AggregateData(model_data, resolution)
+            self.members = model_data.members
+        else:
+            self.members = dict([(e, [e]) for e in model_data.data])
 
         self.df = model_data
 
-        # Number of entities
+        # Number of entities (or classes)
         self.n_entities = len(self.df.data)
 
-        # List of entities
+        # List of entities (or classes)
         self.entities = self.df.data.keys()
 
+        # Number of entities in each class
+        self.count = dict([(e, len(self.members[e])) for e in self.entities])
+
+        # Last allocation set, e.g. the warm start, which disaggregation keeps entities close to
+        self.last_allocation = None
+
         self.variables = dict()
 
+        # Cached squared deviations and group sums of numerical variables
+        self.squared_deviations = dict()
+        self.group_sums = dict()
+
+        # Means the squared deviations are measured from, kept when the entities change
+        self.reference_mean = dict([(v, self.df.numerical[v]['mean']) for v in self.df.numerical])
+
+        # Constraints that change with the entities or group sizes: dictionary[key] = constraint
+        self.constraints = dict()
+
+        # Allocation variables fixed to zero to break symmetry, as tuples (entity position, group position), and
+        # variables penalised for moving entities
+        self.fixed = list()
+        self.penalised = list()
+
         # Create groups
-        self.groups, self.group_size = self.create_groups(n_groups, self.n_entities)
+        if sizes is None:
+            self.groups, self.group_size = self.create_groups(n_groups, sum(self.count.values()))
+        else:
+            self.check_sizes(sizes, n_groups, sum(self.count.values()))
+            self.groups = range(1, n_groups + 1)
+            self.group_size = dict(zip(self.groups, sizes))
 
         # List of tuple indices
-        tuples = dict()
-        tuples['entity'] = [(e, g) for e in self.entities for g in self.groups]
-        for c in self.df.categorical:
-            tuples[c] = [(i, g) for (i, n) in self.df.categorical[c] for g in self.groups]
+        tuples = self.get_tuples()
 
         # Add variables
-        self.create_variables(tuples)
+        with self.stats.phase('variables'):
+            self.create_variables(tuples)
 
         # Add objective function
-        self.create_objective_function(tuples)
+        with self.stats.phase('objective'):
+            self.create_objective_function(tuples)
 
         # Add entity constraints
-        self.create_entity_constraints()
+        with self.stats.phase('entity constraints'):
+            self.create_entity_constraints()
 
         # Add numerical variable constraints
-        self.add_numerical_constraints()
+        with self.stats.phase('numerical constraints'):
+            self.add_numerical_constraints()
 
         # Add categorical variable constraints
-        self.add_categorical_constraints()
+        with self.stats.phase('categorical constraints'):
+            self.add_categorical_constraints()
+
+        # Add symmetry breaking constraints
+        if symmetry_breaking:
+            with self.stats.phase('symmetry breaking constraints'):
+                self.add_symmetry_breaking_constraints()
 
         return
 
@@ -117,6 +465,78 @@ class PartitionModel(Model):
                 group_size[g] = int(n_entities / n_groups) + 1
         return groups, group_size
 
+    @staticmethod
+    def check_sizes(sizes, n_groups, n_entities):
+        """
+        Raises ValueError unless there is a non-negative size for each group and the sizes add up to the number of
+        entities
+        :param sizes: list of group sizes
+        :param n_groups: number of groups
+        :param n_entities: number of entities
+        :return:
+        """
+
+        if len(sizes) != n_groups:
+            raise ValueError('%d group sizes given for %d groups' % (len(sizes), n_groups))
+        if [n for n in sizes if n < 0] or sum(sizes) != n_entities:
+            raise ValueError('The group sizes %s must be non-negative and add up to the %d entities'
+                             % (list(sizes), n_entities))
+
+        return
+
+    def solve(self, time_limit, initial=None, solver=None, local_search=False, seed=None, job=None):
+        """
+        Solve the model
+        :param time_limit: time limit (seconds)
+        :param initial: dictionary[entity] = group to start from, e.g. allocation['entity-group'] of an earlier
+            solve (optional)
+        :param solver: solver backend, e.g. CBC, GLPK, HiGHS or Portfolio (optional, default CBC)
+        :param local_search: if True, improve an allocation by swapping entities instead of calling the solver
+        :param seed: random seed for the local search (optional)
+        :param job: SolveJob the solve runs in, which can stop the solver (optional)
+        :return: tuple (allocation, quality)
+        """
+
+        if not local_search:
+            return super(PartitionModel, self).solve(time_limit, initial, solver, job)
+
+        with self.stats.phase('local search'):
+            search = SwapSearch(self.entity_data, self.groups, self.group_size, seed)
+            if initial is not None:
+                initial = [self.groups.index(initial[e]) for e in search.entities]
+            self.set_solution(search.search(time_limit, initial), search.get_violations())
+
+        with self.stats.phase('process solution'):
+            return self.process_solution()
+
+    def get_key(self):
+        """
+        Data and parameters the solution of the model depends on, including the disruption costs of resolve
+        :return: list
+        """
+
+        costs = list()
+        if self.penalised:
+            penalised = set([x.name for x in self.penalised])
+            costs = sorted([(e, g, self.model.objective[x]) for ((e, g), x) in self.variables['x'].items()
+                            if x.name in penalised])
+
+        return [get_data_fingerprint(self.entity_data), sorted(self.group_size.items()), self.symmetry_breaking,
+                self.aggregate, self.resolution, sorted(self.reference_mean.items()), costs]
+
+    def get_tuples(self):
+        """
+        Indices of the allocation and categorical violation variables
+        :return: dictionary[variable] = list of tuples
+        """
+
+        tuples = dict()
+        tuples['entity'] = [(e, g) for e in self.entities for g in self.groups]
+        for c in self.df.categorical:
+            tuples[c] = [(i, g) for (i, n) in self.df.categorical[c] for g in self.groups]
+
+        return tuples
+
     def create_variables(self, tuples):
         """
 
@@ -124,8 +544,10 @@ class PartitionModel(Model):
         :return:
         """
 
-        # Entity allocation variables
-        self.variables['x'] = LpVariable.dicts('x', tuples['entity'], None, None, LpBinary)
+        # Entity allocation variables: number of entities of each class in each group (binary without aggregation)
+        self.variables['x'] = LpVariable.dicts('x', tuples['entity'], 0, None, LpInteger)
+        for (e, g) in tuples['entity']:
+            self.variables['x'][(e, g)].upBound = self.count[e]
 
         for c in self.df.categorical:
             # Penalty variables for violating categorical constraints
@@ -182,8 +604,20 @@ class PartitionModel(Model):
         """
 
         for e in self.entities:
-            # Each entity can be assigned to one group
-            self.model += lpSum([self.variables['x'][(e, g)] for g in self.groups]) == 1, "entity_%s" % e
+            self.add_entity_constraint(e)
+
+        return
+
+    def add_entity_constraint(self, e):
+        """
+        Adds the constraint that assigns an entity (or all entities of a class) to groups
+        :param e: entity
+        :return:
+        """
+
+        # Each entity can be assigned to one group
+        self.constraints[('entity', e)] = lpSum([self.variables['x'][(e, g)] for g in self.groups]) == self.count[e]
+        self.model += self.constraints[('entity', e)], "entity_%s" % e
 
         return
 
@@ -195,32 +629,64 @@ class PartitionModel(Model):
 
         for g in self.groups:
             # Each group must contain a certain number of people
-            self.model += lpSum([self.variables['x'][(i, g)] for i in self.df.data]) == self.group_size[g], '%s' % g
+            self.constraints[('size', g)] = lpSum([self.variables['x'][(i, g)] for i in self.df.data]) == \
+                self.group_size[g]
+            self.model += self.constraints[('size', g)], '%s' % g
 
             for v in self.df.numerical:
+                total, squared_total = self.get_group_sums(g, v)
+
                 # Each mean must be bigger than some L.B.
-                self.model += lpSum([self.df.data[i][v] * self.variables['x'][(i, g)] for i in self.df.data]) \
-                    >= self.group_size[g] * self.variables[v]['mean_min']
+                self.constraints[('mean_min', v, g)] = total >= self.group_size[g] * self.variables[v]['mean_min']
 
                 # Each mean must be smaller than some U.B.
-                self.model += lpSum([self.df.data[i][v] * self.variables['x'][(i, g)] for i in self.df.data]) \
-                    <= self.group_size[g] * self.variables[v]['mean_max']
+                self.constraints[('mean_max', v, g)] = total <= self.group_size[g] * self.variables[v]['mean_max']
 
                 # Each variance must be bigger than some L.B.
                 #
                 #   Note: This is an approximation of the variance as we use global mean rather than
                 #       the sample mean (as this would be non-linear)
-                self.model += lpSum([pow(self.df.data[i][v] - self.df.numerical[v]['mean'], 2)
-                                     * self.variables['x'][(i, g)] for i in self.df.data]) \
-                    >= self.group_size[g] * self.variables[v]['var_min']
+                self.constraints[('var_min', v, g)] = squared_total >= self.group_size[g] * self.variables[v]['var_min']
 
                 # Each variance must be smaller than some U.B.
-                self.model += lpSum([pow(self.df.data[i][v] - self.df.numerical[v]['mean'], 2)
-                                     * self.variables['x'][(i, g)] for i in self.df.data]) \
-                    <= self.group_size[g] * self.variables[v]['var_max']
+                self.constraints[('var_max', v, g)] = squared_total <= self.group_size[g] * self.variables[v]['var_max']
+
+                for k in ['mean_min', 'mean_max', 'var_min', 'var_max']:
+                    self.model += self.constraints[(k, v, g)]
 
         return
 
+    def get_squared_deviations(self, v):
+        """
+        Squared deviation of each entity from the mean of a numerical variable.
+        Calculated once per variable and cached
+        :param v: numerical variable
+        :return: array of squared deviations, in the order of the entities
+        """
+
+        if v not in self.squared_deviations:
+            u = self.reference_mean[v]
+            self.squared_deviations[v] = pow(self.df.data.columns[v] - u, 2)
+
+        return self.squared_deviations[v]
+
+    def get_group_sums(self, g, v):
+        """
+        Sum and sum of squared deviations of a numerical variable over the entities in a group.
+        Built once per (group, variable) and cached
+        :param g: group
+        :param v: numerical variable
+        :return: tuple of expressions (sum, sum of squared deviations)
+        """
+
+        if (g, v) not in self.group_sums:
+            x = [self.variables['x'][(i, g)] for i in self.entities]
+            self.group_sums[(g, v)] = (
+                LpAffineExpression(zip(x, self.df.data.columns[v].tolist())),
+                LpAffineExpression(zip(x, self.get_squared_deviations(v).tolist())))
+
+        return self.group_sums[(g, v)]
+
     def add_categorical_constraints(self):
         """
         Adds the categorical constraints
@@ -233,180 +699,583 @@ class PartitionModel(Model):
             for c in self.df.categorical:
                 # For each level in that variable
                 for (l, n) in self.df.categorical[c]:
-                    # L.B.
-                    self.model += lpSum([self.variables['x'][(i, g)] for i in self.df.data if self.df.data[i][c] == l])\
-                        + self.variables[c][(l, g)] >= int(n * self.group_size[g])
-
-                    # U.B.
-                    self.model += lpSum([self.variables['x'][(i, g)] for i in self.df.data if self.df.data[i][c] == l])\
-                        - self.variables[c][(l, g)] <= int(n * self.group_size[g]) + 1
+                    self.add_level_constraints(g, c, l, n)
 
         return
 
-    def extract_results(self):
+    def add_level_constraints(self, g, c, l, n):
         """
-
+        Adds the constraints on the number of entities at a level in a group
+        :param g: group
+        :param c: categorical variable
+        :param l: level
+        :param n: proportion of the entities at the level
         :return:
         """
 
-        allocation = {'entity-group': dict(), 'group-entity': dict()}
-
-        for (e, g) in self.variables['x']:
+        # Number of entities at this level in the group
+        count = lpSum([self.variables['x'][(i, g)] for i in self.df.level_index[c].get(l, [])])
 
-            if self.variables['x'][(e, g)].value() == 1:
+        # L.B.
+        self.constraints[('level_min', c, l, g)] = count + self.variables[c][(l, g)] >= int(n * self.group_size[g])
+        self.model += self.constraints[('level_min', c, l, g)]
 
-                allocation['entity-group'][e] = g
+        # U.B.
+        self.constraints[('level_max', c, l, g)] = count - self.variables[c][(l, g)] <= int(n * self.group_size[g]) + 1
+        self.model += self.constraints[('level_max', c, l, g)]
 
-                if g not in allocation['group-entity']:
-                    allocation['group-entity'][g] = [e]
-                else:
-                    allocation['group-entity'][g].append(e)
+        return
 
-        return allocation
+    def get_symmetric_assignments(self):
+        """
+        Allocation variables that can be fixed to zero without losing every optimal solution.
 
-    def get_numerical_solution_quality(self, allocation):
+        Groups of the same size are interchangeable, so any allocation can be relabelled so that, within
+        each size, groups are ordered by the first entity they contain. The k-th entity (counting from 0)
+        then never belongs to a group ranked higher than k among the groups of its size. With aggregation,
+        the entities are counted class by class.
+        :return: list of tuples (entity position, group position)
         """
 
-        :param allocation:
+        # Rank of each group among the groups of the same size
+        rank = dict()
+        fixed = list()
+        for j, g in enumerate(self.groups):
+            rank[g] = len([h for h in self.groups[:j] if self.group_size[h] == self.group_size[g]])
+
+        # Number of entities up to and including each class
+        total = 0
+        for k, e in enumerate(self.entities):
+            total += self.count[e]
+            if total > max(rank.values()):
+                break
+            for j, g in enumerate(self.groups):
+                if rank[g] >= total:
+                    fixed.append((k, j))
+
+        return fixed
+
+    def add_symmetry_breaking_constraints(self):
+        """
+        Fixes the allocation variables that only appear in relabelled copies of other allocations
         :return:
         """
 
-        quality = dict()
+        self.fixed = self.get_symmetric_assignments()
+        for (k, j) in self.fixed:
+            self.variables['x'][(self.entities[k], self.groups[j])].upBound = 0
 
-        for v in self.df.numerical:
-            quality[v] = {'mean': {'max': None, 'min': None, 'mean': None, 'sd': None},
-                          'var': {'max': None, 'min': None, 'mean': None, 'sd': None}}
-            mean_list = list()
-            var_list = list()
-
-            for g in allocation['group-entity']:
-
-                values = [self.df.data[e][v] for e in allocation['group-entity'][g]]
-
-                mean_list.append(self.mean(values))
-                var_list.append(self.var(values, mean_list[-1]))
-
-            # Add statistical metrics
-            quality[v]['mean']['max'] = max(mean_list)
-            quality[v]['mean']['min'] = min(mean_list)
-            quality[v]['mean']['mean'] = self.mean(mean_list)
-            quality[v]['mean']['sd'] = pow(self.var(mean_list), 0.5)
-            quality[v]['var']['max'] = max(var_list)
-            quality[v]['var']['min'] = min(var_list)
-            quality[v]['var']['mean'] = self.mean(var_list)
-            quality[v]['var']['sd'] = pow(self.var(var_list), 0.5)
-        return quality
+        return
 
-    def get_categorical_solution_quality(self, allocation):
+    def remove_symmetry_breaking(self):
         """
-
-        :param allocation:
+        Frees the allocation variables fixed by add_symmetry_breaking_constraints, once the labels of the groups
+        matter
         :return:
         """
 
-        quality = dict()
+        # Back to the number of entities of the class
+        for (k, j) in self.fixed:
+            self.variables['x'][(self.entities[k], self.groups[j])].upBound = self.count[self.entities[k]]
+        self.fixed = list()
+        self.symmetry_breaking = False
 
-        for c in self.df.categorical:
+        return
 
-            quality[c] = dict()
+    def get_relabelling(self, allocation):
+        """
+        Relabelling of the groups that makes an allocation satisfy the symmetry breaking constraints: within each
+        size, groups are ordered by the first entity they contain, as in get_symmetric_assignments. Without symmetry
+        breaking, every group keeps its label
+        :param allocation: dictionary[entity] = group
+        :return: dictionary[group] = new group
+        """
 
-            for (l, n) in self.df.categorical[c]:
+        if not self.symmetry_breaking:
+            return dict([(g, g) for g in self.groups])
 
-                quality[c][l] = {'max': None, 'min': None, 'mean': None, 'sd': None}
+        # Position of the first entity (or class) in each group
+        first = dict()
+        for k, e in enumerate(self.entities):
+            for m in self.members[e]:
+                first.setdefault(allocation[m], k)
 
-                violation_list = [self.variables[c][(l, g)].value() for g in allocation['group-entity']]
+        # Empty groups go last
+        relabelling = dict()
+        for size in set(self.group_size.values()):
+            groups = [g for g in self.groups if self.group_size[g] == size]
+            relabelling.update(zip(sorted(groups, key=lambda g: first.get(g, len(self.entities))), groups))
 
-                quality[c][l]['max'] = max(violation_list)
-                quality[c][l]['min'] = min(violation_list)
-                quality[c][l]['mean'] = self.mean(violation_list)
-                quality[c][l]['sd'] = pow(self.var(violation_list), 0.5)
-        return quality
+        return relabelling
 
-    def get_solution_quality(self, allocation):
+    def relabel(self, allocation):
         """
-
-        :param allocation:
-        :return:
+        Allocation with the groups relabelled as in get_relabelling, so it can be used as a MIP start
+        :param allocation: dictionary[entity] = group
+        :return: dictionary[entity] = group
         """
-        quality = {'numerical': self.get_numerical_solution_quality(allocation),
-                   'categorical': self.get_categorical_solution_quality(allocation)}
-        return quality
+        relabelling = self.get_relabelling(allocation)
+        return dict([(e, relabelling[g]) for (e, g) in allocation.items()])
 
-    def process_solution(self):
+    def update_entities(self, model_data, sizes=None):
         """
-
-        :return:
+        Updates the model in place for a new set of entities, e.g. after a handful have joined or left.
+
+        Only the constraints and coefficients of the entities added or removed change, and the group sizes and
+        level targets are updated. Squared deviations stay measured from the mean the model was built with, so the
+        coefficients of the other entities are unchanged. Groups keep their labels, so any symmetry breaking is
+        lifted. Follow with resolve to start from the previous allocation.
+        :param model_data: data class of the new set of entities, with the same variables
+        :param sizes: list of group sizes (optional, default near-equal sizes from create_groups)
+        :return: tuple (list of entities added, list of entities removed)
         """
-        allocation = self.extract_results()
-        quality = self.get_solution_quality(allocation)
-        return allocation, quality
 
+        if self.df is not self.entity_data:
+            raise ValueError('Entities cannot be updated in an aggregated model')
+        if set(model_data.numerical) != set(self.df.numerical) or \
+                set(model_data.categorical) != set(self.df.categorical):
+            raise ValueError('The new data must have the same numerical and categorical variables')
+        if sizes is not None:
+            self.check_sizes(sizes, len(self.groups), len(model_data.data))
+
+        added = [e for e in model_data.data if e not in self.df.data]
+        removed = [e for e in self.entities if e not in model_data.data]
+
+        # Labels of the groups matter from now on
+        self.remove_symmetry_breaking()
+
+        for e in removed:
+            self.remove_entity(e, self.df.data[e])
+
+        # PuLP collects the variables of the problem as constraints are added, so they are collected again
+        # without those of the removed entities
+        self.model._variables = list()
+        self.model._variable_ids = dict()
+
+        # The new data is used from here, e.g. for the level index of new levels and the quality reports
+        self.entity_data = self.df = model_data
+        self.entities = list(model_data.data)
+        self.n_entities = len(self.entities)
+        self.members = dict([(e, [e]) for e in self.entities])
+        self.count = dict([(e, 1) for e in self.entities])
+        self.squared_deviations = dict()
+        self.group_sums = dict()
+
+        self.variables['x'].update(LpVariable.dicts('x', [(e, g) for e in added for g in self.groups], 0, 1, LpInteger))
+        for e in added:
+            self.add_entity(e, model_data.data[e])
+
+        if sizes is None:
+            self.group_size = self.create_groups(len(self.groups), self.n_entities)[1]
+        else:
+            self.group_size = dict(zip(self.groups, sizes))
+        self.set_targets()
 
-class DistributionModel(Model):
+        return added, removed
 
-    def __init__(self, old_population, new_population, n_people, name='DistributionModel'):
+    def remove_entity(self, e, row):
         """
-        Instantiates DistributionModel
-        :param old_population: data for population we wish to match
-        :param new_population: data for population we draw entities from
-        :param n_people: number of entities to select from new_population
-        :param name: name of match
+        Removes an entity and its variables from the constraints
+        :param e: entity
+        :param row: dictionary[variable] = value of the entity
         :return:
         """
 
-        # Inherits Model class
-        Model.__init__(self, name)
+        for g in self.groups:
+            x = self.variables['x'].pop((e, g))
 
-        # list of entities
-        self.entities = new_population.data.keys()
+            keys = [('size', g)] + [(k, v, g) for v in self.df.numerical for k in ['mean_min', 'mean_max',
+                                                                                  'var_min', 'var_max']]
+            keys += [(k, c, row[c], g) for c in self.df.categorical for k in ['level_min', 'level_max']]
+            for key in keys:
+                del self.constraints[key][x]
 
-        # Control population (trying to match)
-        self.old_df = old_population
+            if x in self.model.objective:
+                del self.model.objective[x]
 
-        # New population (drawing from)
-        self.new_df = new_population
+        del self.model.constraints[self.constraints.pop(('entity', e)).name]
 
-        # number of people to select from new population
-        self.n_people = n_people
+        return
 
-        # Add the variables
-        self.variables = self.create_variables()
+    def add_entity(self, e, row):
+        """
+        Adds the variables of an entity to the constraints, with the constraints of any level that is new to the model
+        :param e: entity
+        :param row: dictionary[variable] = value of the entity
+        :return:
+        """
 
-        # add the objective function
-        self.create_objective_function()
+        self.add_entity_constraint(e)
 
-        # Add the entity constraints
-        self.add_entity_constraints()
+        for g in self.groups:
+            x = self.variables['x'][(e, g)]
+            self.constraints[('size', g)][x] = 1
 
-        # Add the numeric constraints
-        self.add_numeric_constraints()
+            for v in self.df.numerical:
+                self.constraints[('mean_min', v, g)][x] = row[v]
+                self.constraints[('mean_max', v, g)][x] = row[v]
+                self.constraints[('var_min', v, g)][x] = pow(row[v] - self.reference_mean[v], 2)
+                self.constraints[('var_max', v, g)][x] = pow(row[v] - self.reference_mean[v], 2)
 
-        # Add the categorical constraints
-        self.add_categorical_constraints()
+        for c in self.df.categorical:
+            l = row[c]
+            if ('level_min', c, l, self.groups[0]) in self.constraints:
+                for g in self.groups:
+                    self.constraints[('level_min', c, l, g)][self.variables['x'][(e, g)]] = 1
+                    self.constraints[('level_max', c, l, g)][self.variables['x'][(e, g)]] = 1
+                continue
+
+            # A level new to the model, with its targets set by set_targets
+            for g in self.groups:
+                self.variables[c][(l, g)] = LpVariable('%s_violation_%s' % (c, (l, g)), 0, None)
+                self.model.objective[self.variables[c][(l, g)]] = 1e4
+                self.add_level_constraints(g, c, l, 0)
 
         return
 
-    def create_variables(self):
+    def set_targets(self):
         """
-        Add the variables to the model
+        Sets the group sizes and level targets of the constraints, from group_size and the level proportions
         :return:
         """
 
-        variables = dict()
+        for g in self.groups:
+            self.constraints[('size', g)].changeRHS(self.group_size[g])
 
-        # Entity variables
-        variables['x'] = LpVariable.dicts('x', self.entities, None, None, LpBinary)
+            for v in self.df.numerical:
+                for k in ['mean_min', 'mean_max', 'var_min', 'var_max']:
+                    self.constraints[(k, v, g)][self.variables[v][k]] = -self.group_size[g]
 
-        # Categorical variables
-        for c in self.new_df.categorical:
-            variables[c] = LpVariable.dicts('%s_violation' % c, [a for a, b in self.new_df.categorical[c]], 0, None)
+            for c in self.df.categorical:
+                proportions = dict(self.df.categorical[c])
+                for (l, h) in self.variables[c]:
+                    if h == g:
+                        n = proportions.get(l, 0)
+                        self.constraints[('level_min', c, l, g)].changeRHS(int(n * self.group_size[g]))
+                        self.constraints[('level_max', c, l, g)].changeRHS(int(n * self.group_size[g]) + 1)
 
-        # Numerical variables
-        for v in self.new_df.numerical:
-            variables[v] = dict()
-            variables[v]['mean_p'] = LpVariable('%s_mean_p' % v, 0, None)
-            variables[v]['mean_n'] = LpVariable('%s_mean_n' % v, 0, None)
-            variables[v]['var_p'] = LpVariable('%s_var_p' % v, 0, None)
+        return
+
+    def resolve(self, time_limit, previous, disruption=0, solver=None):
+        """
+        Solves the model after update_entities, starting from the previous allocation.
+
+        Entities keep their previous group in the warm start and new entities fill the places left. With a
+        disruption cost, moving an entity away from its previous group adds that cost to the objective, on the
+        scale of the mean and variance ranges (which are relative to the population mean and variance).
+        :param time_limit: time limit (seconds)
+        :param previous: dictionary[entity] = group, e.g. allocation['entity-group'] of the last solve
+        :param disruption: objective cost of moving each entity of the previous allocation (optional)
+        :param solver: solver backend, e.g. CBC, GLPK, HiGHS or Portfolio (optional, default CBC)
+        :return: tuple (allocation, quality)
+        """
+
+        if self.df is not self.entity_data:
+            raise ValueError('Entities cannot be updated in an aggregated model')
+
+        # Entities are kept in their previous groups by label
+        self.remove_symmetry_breaking()
+
+        # Remove the costs of an earlier resolve
+        for x in self.penalised:
+            if x in self.model.objective:
+                del self.model.objective[x]
+        self.penalised = list()
+
+        kept = [e for e in self.entities if previous.get(e) in self.group_size]
+        if disruption:
+            for e in kept:
+                self.penalised.append(self.variables['x'][(e, previous[e])])
+                self.model.objective[self.penalised[-1]] = -disruption
+
+        # Warm start: previous groups where they have room, then the groups with the most places left
+        initial = dict()
+        places = dict(self.group_size)
+        for e in kept:
+            if places[previous[e]] > 0:
+                initial[e] = previous[e]
+                places[previous[e]] -= 1
+        for e in self.entities:
+            if e not in initial:
+                initial[e] = max(self.groups, key=lambda g: places[g])
+                places[initial[e]] -= 1
+
+        return self.solve(time_limit, initial, solver)
+
+    def set_solution(self, allocation, violations):
+        """
+        Sets the variable values from an allocation found without the solver
+        :param allocation: dictionary[entity] = group
+        :param violations: dictionary[categorical][(level, group)] = violation
+        :return:
+        """
+
+        # The groups are relabelled as in set_allocation
+        relabelling = self.get_relabelling(allocation)
+        self.set_allocation(allocation)
+
+        for c in violations:
+            for (l, g) in violations[c]:
+                self.set_value(self.variables[c][(l, relabelling[g])], violations[c][(l, g)])
+
+        return
+
+    def set_allocation(self, allocation):
+        """
+        Sets the values of the allocation variables. With symmetry breaking, the groups are relabelled so the
+        values satisfy it
+        :param allocation: dictionary[entity] = group
+        :return:
+        """
+
+        allocation = self.relabel(allocation)
+        self.last_allocation = allocation
+
+        counts = self.get_class_counts(allocation)
+        for (e, g) in self.variables['x']:
+            self.set_value(self.variables['x'][(e, g)], counts.get((e, g), 0))
+
+        return
+
+    def get_class_counts(self, allocation):
+        """
+        Number of entities of each class in each group
+        :param allocation: dictionary[entity] = group
+        :return: dictionary[(class, group)] = number of entities
+        """
+
+        counts = dict()
+        for k in self.entities:
+            for e in self.members[k]:
+                counts[(k, allocation[e])] = counts.get((k, allocation[e]), 0) + 1
+
+        return counts
+
+    def disaggregate(self, counts):
+        """
+        Allocation of the entities from the number of entities of each class in each group
+        :param counts: list of tuples (class, group, number of entities)
+        :return: allocation
+        """
+
+        allocation = {'entity-group': dict(), 'group-entity': dict()}
+
+        # Entities stay in the group they had in the last allocation set, where the counts allow
+        last = dict() if self.last_allocation is None else self.last_allocation
+        chosen = dict()
+        used = set()
+        for (k, g, n) in counts:
+            if n == len(self.members[k]):
+                # The whole class is in one group, so there is nothing to choose
+                chosen[(k, g)] = self.members[k]
+                continue
+            chosen[(k, g)] = [e for e in self.members[k] if last.get(e) == g][:n]
+            used.update(chosen[(k, g)])
+
+        # The other entities of each class fill the remaining places
+        free = dict()
+        for (k, g, n) in counts:
+            if n == len(chosen[(k, g)]):
+                continue
+            if k not in free:
+                free[k] = [e for e in self.members[k] if e not in used]
+            m = n - len(chosen[(k, g)])
+            chosen[(k, g)] += free[k][:m]
+            free[k] = free[k][m:]
+
+        for (k, g, n) in counts:
+            for e in chosen[(k, g)]:
+                allocation['entity-group'][e] = g
+
+                if g not in allocation['group-entity']:
+                    allocation['group-entity'][g] = [e]
+                else:
+                    allocation['group-entity'][g].append(e)
+
+        return allocation
+
+    def get_allocation_values(self):
+        """
+        Values of the allocation variables
+        :return: array (entity position, group position) of values
+        """
+        return numpy.array([[self.variables['x'][(e, g)].varValue or 0.0 for g in self.groups] for e in self.entities])
+
+    @staticmethod
+    def round_counts(values, totals, tolerance=1e-6):
+        """
+        Rounds the allocation variables so each row adds up to its total.
+        Values within the tolerance below an integer are rounded up, and places still left in a row go to the
+        largest fractional parts, so with binary variables each entity goes to its largest value and never to no group
+        :param values: array (entity position, group position) of values
+        :param totals: list of the number of entities in each row
+        :param tolerance: integrality tolerance (optional)
+        :return: array (entity position, group position) of counts
+        """
+
+        values = numpy.maximum(values, 0.0)
+        counts = numpy.floor(values + tolerance).astype(int)
+        remainder = numpy.asarray(totals, dtype=int) - counts.sum(axis=1)
+
+        # Only the rows that are short are ranked
+        rows = numpy.nonzero(remainder > 0)[0]
+        if len(rows):
+            rank = numpy.argsort(numpy.argsort(counts[rows] - values[rows], axis=1), axis=1)
+            counts[rows] += rank < remainder[rows][:, numpy.newaxis]
+
+        return counts
+
+    def extract_results(self):
+        """
+        Allocation from the values of the allocation variables, built from the non-zero counts only.
+        Raises PulpSolverError if the values are not an allocation with the group sizes, e.g. the continuous
+        relaxation written by a solver stopped before it found an integer solution
+        :return:
+        """
+
+        counts = self.round_counts(self.get_allocation_values(), [self.count[e] for e in self.entities])
+        if counts.sum(axis=0).tolist() != [self.group_size[g] for g in self.groups]:
+            raise PulpSolverError('No integer solution found: the solution does not have the group sizes')
+        rows, cols = numpy.nonzero(counts)
+
+        return self.disaggregate(zip([self.entities[k] for k in rows], [self.groups[j] for j in cols],
+                                     counts[rows, cols].tolist()))
+
+    def get_solution_quality(self, allocation):
+        """
+        Quality report of an allocation, computed from the entity data
+        :param allocation:
+        :return:
+        """
+        return QualityEvaluator(self.entity_data).get_partition_quality(allocation)
+
+    def get_numerical_solution_quality(self, allocation):
+        """
+        Numerical part of the quality report, kept for compatibility. Use get_solution_quality
+        :param allocation:
+        :return: dictionary[variable]['mean'/'var'] of quality metrics
+        """
+        return self.get_solution_quality(allocation)['numerical']
+
+    def get_categorical_solution_quality(self, allocation):
+        """
+        Categorical part of the quality report, kept for compatibility. Use get_solution_quality
+        :param allocation:
+        :return: dictionary[variable][level] of quality metrics
+        """
+        return self.get_solution_quality(allocation)['categorical']
+
+    def process_solution(self):
+        """
+
+        :return:
+        """
+        allocation = self.extract_results()
+        quality = self.get_solution_quality(allocation)
+        return allocation, quality
+
+
+class DistributionModel(Model):
+
+    def __init__(self, old_population, new_population, n_people, name='DistributionModel', aggregate=False,
+                 resolution=None):
+        """
+        Instantiates DistributionModel
+        :param old_population: data for population we wish to match
+        :param new_population: data for population we draw entities from
+        :param n_people: number of entities to select from new_population
+        :param name: name of match
+        :param aggregate: if True, model equivalent entities of new_population as one class with an integer count
+            of entities selected (optional)
+        :param resolution: dictionary[numerical variable] = bucket width when aggregating (optional)
+        :return:
+        """
+
+        # Inherits Model class
+        super(DistributionModel, self).__init__(name)
+
+        # Data of the entities being selected from
+        self.entity_data = new_population
+
+        # Options the model was built with
+        self.aggregate = aggregate
+        self.resolution = resolution
+
+        if aggregate:
+            # Equivalent entities are modelled as one class
+            new_population = AggregateData(new_population, resolution)
+            self.members = new_population.members
+        else:
+            self.members = dict([(e, [e]) for e in new_population.data])
+
+        # list of entities (or classes)
+        self.entities = new_population.data.keys()
+
+        # Last allocation set, e.g. the warm start, which disaggregation keeps entities close to
+        self.last_allocation = None
+
+        # Control population (trying to match)
+        self.old_df = old_population
+
+        # New population (drawing from)
+        self.new_df = new_population
+
+        # number of people to select from new population
+        self.n_people = n_people
+
+        # Add the variables
+        with self.stats.phase('variables'):
+            self.variables = self.create_variables()
+
+        # add the objective function
+        with self.stats.phase('objective'):
+            self.create_objective_function()
+
+        # Add the entity constraints
+        with self.stats.phase('entity constraints'):
+            self.add_entity_constraints()
+
+        # Add the numeric constraints
+        with self.stats.phase('numerical constraints'):
+            self.add_numeric_constraints()
+
+        # Add the categorical constraints
+        with self.stats.phase('categorical constraints'):
+            self.add_categorical_constraints()
+
+        return
+
+    def get_key(self):
+        """
+        Data and parameters the solution of the model depends on
+        :return: list
+        """
+        return [get_data_fingerprint(self.old_df), get_data_fingerprint(self.entity_data), self.n_people,
+                self.aggregate, self.resolution]
+
+    def create_variables(self):
+        """
+        Add the variables to the model
+        :return:
+        """
+
+        variables = dict()
+
+        # Entity variables
+        variables['x'] = LpVariable.dicts('x', self.entities, 0, None, LpInteger)
+        for i in self.entities:
+            variables['x'][i].upBound = len(self.members[i])
+
+        # Categorical variables
+        for c in self.new_df.categorical:
+            variables[c] = LpVariable.dicts('%s_violation' % c, [a for a, b in self.new_df.categorical[c]], 0, None)
+
+        # Numerical variables
+        for v in self.new_df.numerical:
+            variables[v] = dict()
+            variables[v]['mean_p'] = LpVariable('%s_mean_p' % v, 0, None)
+            variables[v]['mean_n'] = LpVariable('%s_mean_n' % v, 0, None)
+            variables[v]['var_p'] = LpVariable('%s_var_p' % v, 0, None)
             variables[v]['var_n'] = LpVariable('%s_var_n' % v, 0, None)
         return variables
 
@@ -416,162 +1285,3073 @@ class DistributionModel(Model):
         :return:
         """
 
-        obj = None
+        obj = None
+
+        for v in self.new_df.numerical:
+            # Difference between means of each population
+            obj += self.variables[v]['mean_p'] + self.variables[v]['mean_n']
+
+            # Difference between the variance of each population
+            obj += self.variables[v]['var_p'] + self.variables[v]['var_n']
+
+        # Penalise violations
+        obj += 1e4 * lpSum([self.variables[c] for c in self.new_df.categorical])
+
+        # TODO: weightings on variables
+
+        # Add to model
+        self.model += obj
+
+        return
+
+    def add_entity_constraints(self):
+        """
+        Adds entity constraints to model
+        :return:
+        """
+
+        self.model += lpSum([self.variables['x'][i] for i in self.entities]) == self.n_people
+
+        return
+
+    def add_numeric_constraints(self):
+        """
+        Add the numeric constraints
+        :return:
+        """
+
+        x = [self.variables['x'][i] for i in self.entities]
+
+        # For each numeric variable
+        for v in self.new_df.numerical:
+            values = self.new_df.data.columns[v]
+
+            # Make the means similar
+            self.model += LpAffineExpression(zip(x, values.tolist())) \
+                / self.n_people - self.old_df.numerical[v]["mean"] \
+                == self.variables[v]['mean_p'] - self.variables[v]['mean_n']
+
+            # Make the variances similar
+            self.model += LpAffineExpression(zip(x, pow(values - self.new_df.numerical[v]['mean'], 2).tolist())) \
+                / self.n_people - self.old_df.numerical[v]['var'] \
+                == self.variables[v]['var_p'] - self.variables[v]['var_n']
+
+        return
+
+    @staticmethod
+    def get_proportion(my_list, level):
+        """
+        gets proportion from list of tuples (level, proportion)
+        :param my_list: list of tuples from categorical variable
+        :param level: level of categorical variable
+        :return: proportion
+        """
+
+        # For each tuple in list
+        for l, n in my_list:
+            if level == l:
+                # Return proportion
+                return n
+
+        # Level not in list
+        return 0.0
+
+    def add_categorical_constraints(self):
+        """
+        Add categorical constraints
+        :return:
+        """
+
+        # For each categorical variable
+        for c in self.new_df.categorical:
+            # For each level in that variable
+            for (l, n) in self.new_df.categorical[c]:
+                # Goal proportion
+                m = self.get_proportion(self.old_df.categorical[c], l)
+
+                # Number of entities selected at this level
+                count = lpSum([self.variables['x'][i] for i in self.new_df.level_index[c].get(l, [])])
+
+                # L.B.
+                self.model += count + self.variables[c][l] >= int(m * self.n_people)
+
+                # U.B.
+                self.model += count - self.variables[c][l] <= int(m * self.n_people) + 1
+
+        return
+
+    def set_allocation(self, allocation):
+        """
+        Sets the values of the entity variables
+        :param allocation: list of selected entities
+        :return:
+        """
+
+        self.last_allocation = allocation
+
+        for (i, n) in self.get_class_counts(allocation):
+            self.set_value(self.variables['x'][i], n)
+
+        return
+
+    def get_class_counts(self, allocation):
+        """
+        Number of selected entities of each class
+        :param allocation: list of selected entities
+        :return: list of tuples (class, number of entities)
+        """
+
+        selected = set(allocation)
+        return [(i, len([e for e in self.members[i] if e in selected])) for i in self.entities]
+
+    def disaggregate(self, counts):
+        """
+        Selected entities from the number of entities selected from each class
+        :param counts: list of tuples (class, number of entities)
+        :return: list of selected entities
+        """
+
+        # Entities selected in the last allocation set, e.g. the warm start, are selected first
+        last = set() if self.last_allocation is None else set(self.last_allocation)
+
+        selection = list()
+        for (i, n) in counts:
+            selection += ([e for e in self.members[i] if e in last] + [e for e in self.members[i] if e not in last])[:n]
+
+        return selection
+
+    def get_counts(self, values, tolerance=1e-6):
+        """
+        Numbers of entities selected from each class, from the values of the entity variables.
+        Raises PulpSolverError if the values are not integer or do not select n_people, e.g. the continuous
+        relaxation written by a solver stopped before it found an integer solution
+        :param values: array of values, in the order of the entities
+        :param tolerance: integrality tolerance (optional)
+        :return: array of counts
+        """
+
+        counts = numpy.round(values).astype(int)
+        if (len(values) and numpy.abs(values - counts).max() > tolerance) or counts.sum() != self.n_people:
+            raise PulpSolverError('No integer solution found: the solution does not select %d entities'
+                                  % self.n_people)
+
+        return counts
+
+    def extract_results(self):
+        """
+        Get assignment
+        :return:
+        """
+
+        keys = list(self.variables['x'])
+        counts = self.get_counts(numpy.array([self.value(self.variables['x'][i]) or 0.0 for i in keys]))
+
+        return self.disaggregate(zip(keys, counts.tolist()))
+
+    def get_solution_quality(self, allocation=None):
+        """
+        get quality report, computed from the entity data
+        :param allocation: list of selected entities (optional, default the solution)
+        :return:
+        """
+
+        if allocation is None:
+            allocation = self.extract_results()
+
+        return QualityEvaluator(self.entity_data).get_selection_quality(allocation, self.old_df)
+
+    def get_numerical_solution_quality(self):
+        """
+        Numerical part of the quality report of the solution, kept for compatibility. Use get_solution_quality
+        :return: dictionary[variable]['mean'/'var'] = deviation from the target
+        """
+        return self.get_solution_quality()['numerical']
+
+    def get_categorical_solution_quality(self):
+        """
+        Categorical part of the quality report of the solution, kept for compatibility. Use get_solution_quality
+        :return: dictionary[variable][level] = violation
+        """
+        return self.get_solution_quality()['categorical']
+
+    def process_solution(self):
+        """
+        get results and build quality report
+        :return:
+        """
+
+        allocation = self.extract_results()
+        quality = self.get_solution_quality(allocation)
+
+        return allocation, quality
+
+
+class QualityEvaluator(object):
+    """
+    Quality report of an allocation, computed from the data alone.
+
+    Works for any allocation, whether or not it came from a solved model. Entities are reduced to arrays of
+    positions and group numbers, and every group total is a single bincount, so scoring an allocation of a million
+    entities takes milliseconds once it is given as an array.
+    """
+
+    def __init__(self, model_data):
+        """
+        Instantiate QualityEvaluator
+        :param model_data: data class of the entities allocated
+        :return:
+        """
+
+        self.df = model_data
+        self.table = model_data.data
+
+        # dictionary[categorical variable][level] = code
+        self.codes = dict([(c, dict([(l, k) for (k, l) in self.table.levels[c].items()])) for c in self.table.levels])
+
+        return
+
+    def get_labels(self, allocation):
+        """
+        Positions of the allocated entities and the group of each
+        :param allocation: allocation from a model, dictionary[entity] = group, or array of the group of every
+            entity in the order of the data
+        :return: tuple (positions of the entities, list of groups, array of group numbers of the entities)
+        """
+
+        if isinstance(allocation, dict):
+            allocation = allocation.get('entity-group', allocation)
+            positions = self.table.get_positions(allocation.keys())
+            groups = numpy.array(allocation.values())
+        else:
+            # Every entity, without copying
+            positions = slice(None)
+            groups = numpy.asarray(allocation)
+
+        if groups.dtype.kind in 'iu' and len(groups) and groups.min() >= 0:
+            # Groups numbered from 0 or 1 are renumbered by a lookup rather than by sorting
+            present = numpy.nonzero(numpy.bincount(groups))[0]
+            lookup = numpy.zeros(present[-1] + 1, dtype=int)
+            lookup[present] = numpy.arange(len(present))
+            return positions, present.tolist(), lookup[groups]
+
+        groups, labels = numpy.unique(groups, return_inverse=True)
+
+        return positions, groups.tolist(), labels
+
+    @staticmethod
+    def get_summary(x):
+        """
+        Summary of a statistic over the groups
+        :param x: array of values, one per group
+        :return: dictionary[metric (max/min/mean/sd)] = value
+        """
+
+        statistics = Statistics(x)
+        return {'max': float(numpy.max(x)), 'min': float(numpy.min(x)), 'mean': statistics.mean,
+                'sd': pow(statistics.get_var(), 0.5)}
+
+    @staticmethod
+    def get_violations(counts, targets):
+        """
+        Violations of the constraints that keep counts between target and target + 1
+        :param counts: array of counts
+        :param targets: array of targets
+        :return: array of violations
+        """
+        return numpy.maximum(numpy.maximum(targets - counts, counts - targets - 1), 0)
+
+    def get_level_counts(self, c, positions, labels, n_groups):
+        """
+        Number of entities at each level of a categorical variable in each group
+        :param c: categorical variable
+        :param positions: array of positions of the entities
+        :param labels: array of group numbers of the entities
+        :param n_groups: number of groups
+        :return: array (group, level code) of counts
+        """
+
+        n_levels = len(self.table.levels[c])
+        counts = numpy.bincount(labels * n_levels + self.table.codes[c][positions], minlength=n_groups * n_levels)
+        return counts.reshape((n_groups, n_levels))
+
+    def get_level_count(self, counts, c, l):
+        """
+        Column of the counts of a level, zero if no entity has the level
+        :param counts: array (group, level code) of counts
+        :param c: categorical variable
+        :param l: level
+        :return: array of counts
+        """
+
+        if l not in self.codes[c]:
+            return numpy.zeros(counts.shape[0], dtype=int)
+        return counts[:, self.codes[c][l]]
+
+    def get_partition_quality(self, allocation):
+        """
+        Quality report of a partition into groups, as returned by PartitionModel.solve. Group variances divide by
+        the group size, and the level targets are those of PartitionModel
+        :param allocation: allocation from a model, dictionary[entity] = group, or array of the group of every
+            entity in the order of the data
+        :return: dictionary['numerical'/'categorical'] of quality metrics
+        """
+
+        positions, groups, labels = self.get_labels(allocation)
+        size = numpy.bincount(labels, minlength=len(groups))
+
+        quality = {'numerical': dict(), 'categorical': dict()}
+
+        for v in self.df.numerical:
+            values = self.table.columns[v][positions]
+
+            # Group means, and group variances about them
+            means = numpy.bincount(labels, values, len(groups)) / size
+            variances = numpy.bincount(labels, pow(values - means[labels], 2), len(groups)) / size
+
+            quality['numerical'][v] = {'mean': self.get_summary(means), 'var': self.get_summary(variances)}
+
+        for c in self.df.categorical:
+            counts = self.get_level_counts(c, positions, labels, len(groups))
+
+            quality['categorical'][c] = dict()
+            for (l, n) in self.df.categorical[c]:
+                targets = numpy.floor(n * size)
+                violations = self.get_violations(self.get_level_count(counts, c, l), targets)
+                quality['categorical'][c][l] = self.get_summary(violations.astype(float))
+
+        return quality
+
+    def get_selection_quality(self, selection, target_data):
+        """
+        Quality report of a selection that should match another population, as returned by DistributionModel.solve.
+        The variance is about the mean of all the entities, and the level targets are those of DistributionModel
+        :param selection: list of selected entities
+        :param target_data: data class of the population to match
+        :return: dictionary['numerical'/'categorical'] of quality metrics
+        """
+
+        positions = self.table.get_positions(selection)
+        n = len(positions)
+
+        quality = {'numerical': dict(), 'categorical': dict()}
+
+        for v in self.df.numerical:
+            values = self.table.columns[v][positions]
+
+            mean = float(values.sum()) / n
+            var = float(pow(values - self.df.numerical[v]['mean'], 2).sum()) / n
+
+            quality['numerical'][v] = {'mean': abs(mean - target_data.numerical[v]['mean']),
+                                       'var': abs(var - target_data.numerical[v]['var'])}
+
+        for c in self.df.categorical:
+            counts = self.get_level_counts(c, positions, numpy.zeros(n, dtype=int), 1)
+
+            quality['categorical'][c] = dict()
+            for (l, m) in self.df.categorical[c]:
+                target = numpy.floor(DistributionModel.get_proportion(target_data.categorical[c], l) * n)
+                quality['categorical'][c][l] = float(self.get_violations(self.get_level_count(counts, c, l), target))
+
+        return quality
+
+
+class SparseMatrix(object):
+    """
+    Mixed integer program stored as sparse (COO) arrays and written straight to an MPS file.
+
+    Columns are referred to by integer index. Row i is written as R<i> and column j as C<j>.
+    """
+
+    def __init__(self, name):
+        """
+        Instantiate SparseMatrix
+        :param name: model name
+        :return:
+        """
+
+        self.name = name
+
+        # Number of columns and rows
+        self.n_cols = 0
+        self.n_rows = 0
+
+        # Blocks of columns: (lower bounds, upper bounds, integer)
+        self.col_blocks = list()
+
+        # Blocks of rows: (sense, right hand sides)
+        self.row_blocks = list()
+
+        # Blocks of non-zeros: (rows, columns, values)
+        self.entries = list()
+
+        # Objective coefficients: dictionary[column] = coefficient
+        self.objective = dict()
+
+        return
+
+    def add_variables(self, n, low=None, up=None, integer=False):
+        """
+        Add a block of variables
+        :param n: number of variables
+        :param low: lower bound, or array of lower bounds (None for -inf)
+        :param up: upper bound, or array of upper bounds (None for +inf)
+        :param integer: True if the variables are integer
+        :return: array of column indices
+        """
+
+        low = -numpy.inf if low is None else low
+        up = numpy.inf if up is None else up
+
+        cols = numpy.arange(self.n_cols, self.n_cols + n)
+        self.col_blocks.append((numpy.zeros(n) + low, numpy.zeros(n) + up, integer))
+        self.n_cols += n
+
+        return cols
+
+    def add_variable(self, low=None, up=None, integer=False):
+        """
+        Add a single variable
+        :param low: lower bound (None for -inf)
+        :param up: upper bound (None for +inf)
+        :param integer: True if the variable is integer
+        :return: column index
+        """
+        return int(self.add_variables(1, low, up, integer)[0])
+
+    def add_constraints(self, rows, cols, values, sense, rhs):
+        """
+        Add a block of constraints with the same sense
+        :param rows: row of each non-zero, numbered from 0 within the block
+        :param cols: column of each non-zero
+        :param values: value of each non-zero
+        :param sense: 'L' (<=), 'G' (>=) or 'E' (==)
+        :param rhs: right hand side of each row
+        :return: array of row indices
+        """
+
+        rhs = numpy.asarray(rhs, dtype=float)
+
+        self.entries.append((numpy.asarray(rows) + self.n_rows, numpy.asarray(cols),
+                             numpy.asarray(values, dtype=float)))
+        self.row_blocks.append((sense, rhs))
+
+        rows = numpy.arange(self.n_rows, self.n_rows + len(rhs))
+        self.n_rows += len(rhs)
+
+        return rows
+
+    def add_constraint(self, cols, values, sense, rhs):
+        """
+        Add a single constraint
+        :param cols: columns of the non-zeros
+        :param values: values of the non-zeros
+        :param sense: 'L' (<=), 'G' (>=) or 'E' (==)
+        :param rhs: right hand side
+        :return: row index
+        """
+        return int(self.add_constraints(numpy.zeros(len(cols), dtype=int), cols, values, sense, [rhs])[0])
+
+    def change_constraint(self, row, sense, rhs):
+        """
+        Change the sense and right hand side of a constraint. The sense of a row in a block of several rows
+        cannot change
+        :param row: row index
+        :param sense: 'L' (<=), 'G' (>=) or 'E' (==)
+        :param rhs: right hand side
+        :return:
+        """
+
+        start = 0
+        for i, (block_sense, block_rhs) in enumerate(self.row_blocks):
+            if row < start + len(block_rhs):
+                if sense != block_sense and len(block_rhs) > 1:
+                    raise ValueError('The sense of row %d cannot change within its block' % row)
+                block_rhs = block_rhs.copy()
+                block_rhs[row - start] = rhs
+                self.row_blocks[i] = (sense, block_rhs)
+                return
+            start += len(block_rhs)
+
+        raise ValueError('No row %d' % row)
+
+    def set_objective(self, col, value):
+        """
+        Set the objective coefficient of a column
+        :param col: column index
+        :param value: coefficient
+        :return:
+        """
+        self.objective[col] = value
+        return
+
+    def write_mps(self, filename):
+        """
+        Write the model to an MPS file
+        :param filename: full filepath of file
+        :return:
+        """
+
+        # The objective is written as the row after the constraints
+        obj = self.n_rows
+
+        # Non-zeros, including the objective, sorted by column
+        rows = numpy.concatenate([e[0] for e in self.entries] + [numpy.repeat(obj, len(self.objective))])
+        cols = numpy.concatenate([e[1] for e in self.entries] + [numpy.array(list(self.objective.keys()), dtype=int)])
+        values = numpy.concatenate([e[2] for e in self.entries] + [numpy.array(list(self.objective.values()))])
+
+        # Every column must appear in the COLUMNS section
+        empty = numpy.nonzero(numpy.bincount(cols, minlength=self.n_cols) == 0)[0]
+        rows = numpy.concatenate([rows, numpy.repeat(obj, len(empty))])
+        cols = numpy.concatenate([cols, empty])
+        values = numpy.concatenate([values, numpy.zeros(len(empty))])
+
+        order = numpy.lexsort((rows, cols))
+        rows, cols, values = rows[order], cols[order], values[order]
+        starts = numpy.searchsorted(cols, numpy.arange(self.n_cols + 1))
+
+        with open(filename, 'w') as f:
+            f.write('NAME          %s\n' % self.name)
+
+            # Rows
+            f.write('ROWS\n')
+            f.write(' N  R%d\n' % obj)
+            i = 0
+            for sense, rhs in self.row_blocks:
+                f.writelines([' %s  R%d\n' % (sense, r) for r in range(i, i + len(rhs))])
+                i += len(rhs)
+
+            # Matrix, one block of columns at a time so integer blocks can be marked
+            f.write('COLUMNS\n')
+            j = 0
+            for low, up, integer in self.col_blocks:
+                k = slice(starts[j], starts[j + len(low)])
+                if integer:
+                    f.write("    MARKER    'MARKER'    'INTORG'\n")
+                f.writelines(['    C%d  R%d  %.12g\n' % entry for entry in
+                              zip(cols[k].tolist(), rows[k].tolist(), values[k].tolist())])
+                if integer:
+                    f.write("    MARKER    'MARKER'    'INTEND'\n")
+                j += len(low)
+
+            # Right hand sides
+            f.write('RHS\n')
+            i = 0
+            for sense, rhs in self.row_blocks:
+                nonzero = numpy.nonzero(rhs)[0]
+                f.writelines(['    RHS  R%d  %.12g\n' % entry for entry in
+                              zip((nonzero + i).tolist(), rhs[nonzero].tolist())])
+                i += len(rhs)
+
+            # Bounds
+            f.write('BOUNDS\n')
+            j = 0
+            for low, up, integer in self.col_blocks:
+                for c, l, u in zip(range(j, j + len(low)), low.tolist(), up.tolist()):
+                    if integer and l == 0 and u == 1:
+                        f.write(' BV BND  C%d\n' % c)
+                    elif l == -numpy.inf and u == numpy.inf:
+                        f.write(' FR BND  C%d\n' % c)
+                    else:
+                        if l == -numpy.inf:
+                            f.write(' MI BND  C%d\n' % c)
+                        elif l != 0 or integer:
+                            f.write(' LO BND  C%d  %.12g\n' % (c, l))
+                        if u != numpy.inf:
+                            f.write(' UP BND  C%d  %.12g\n' % (c, u))
+                j += len(low)
+
+            f.write('ENDATA\n')
+
+        return
+
+    def write_mip_start(self, filename, values):
+        """
+        Write the values of the integer columns as a CBC MIP start file
+        :param filename: full filepath of file
+        :param values: array of column values
+        :return:
+        """
+
+        with open(filename, 'w') as f:
+            j = 0
+            for low, up, integer in self.col_blocks:
+                if integer:
+                    f.writelines(['%d C%d %.12g\n' % (c, c, values[c]) for c in range(j, j + len(low))])
+                j += len(low)
+
+        return
+
+    def get_column_values(self, values):
+        """
+        Array of column values from a solution
+        :param values: dictionary[column name] = value
+        :return: array of column values
+        """
+
+        solution = numpy.zeros(self.n_cols)
+        for name in values:
+            if name[0] == 'C':
+                solution[int(name[1:])] = values[name]
+
+        return solution
+
+
+class MatrixModel(Model):
+    """
+    Model built as a SparseMatrix instead of PuLP objects, for models with a very large number of variables
+    """
+
+    def __init__(self, name):
+        super(MatrixModel, self).__init__(name)
+
+        self.matrix = SparseMatrix(name)
+
+        # Solver status and array of column values
+        self.status = None
+        self.solution = None
+        return
+
+    def value(self, variable):
+        """
+        Value of a variable in the solution
+        :param variable: column index
+        :return: value
+        """
+        return self.solution[variable]
+
+    def set_value(self, variable, value):
+        """
+        Set the value of a variable, for solutions found without the solver
+        :param variable: column index
+        :param value: value
+        :return:
+        """
+        if self.solution is None:
+            self.solution = numpy.zeros(self.matrix.n_cols)
+        self.solution[variable] = value
+        return
+
+    def write_mps(self, filename):
+        """
+        Write the model to an MPS file
+        :param filename: full filepath of file
+        :return:
+        """
+        self.matrix.write_mps(filename)
+        return
+
+    def get_size(self):
+        """
+        Size of the model
+        :return: dictionary of the number of variables, constraints and non-zeros
+        """
+        return {'variables': self.matrix.n_cols, 'constraints': self.matrix.n_rows,
+                'nonzeros': sum([len(values) for (rows, cols, values) in self.matrix.entries])}
+
+    def write_mip_start(self, filename):
+        """
+        Write the values of the integer columns as a CBC MIP start file
+        :param filename: full filepath of file
+        :return:
+        """
+        self.matrix.write_mip_start(filename, self.solution)
+        return
+
+    def set_solver_solution(self, status, values):
+        """
+        Sets the column values from a solution read from the solver
+        :param status: PuLP status
+        :param values: dictionary[column name] = value
+        :return:
+        """
+        self.status = status
+        self.solution = self.matrix.get_column_values(values)
+        return
+
+
+class MatrixPartitionModel(PartitionModel, MatrixModel):
+    """
+    PartitionModel built as a SparseMatrix.
+
+    The allocation variables are a (entity, group) array of column indices, so no Python object
+    is created per allocation variable.
+    """
+
+    def __init__(self, model_data, n_groups, name='MatrixPartitionModel', symmetry_breaking=False, sizes=None,
+                 aggregate=False, resolution=None):
+        """
+
+        :param model_data: data class
+        :param n_groups: number of groups to partition into
+        :param name: model name (optional)
+        :param symmetry_breaking: if True, exclude allocations that only relabel groups of the same size (optional)
+        :param sizes: list of group sizes, in place of the near-equal sizes from create_groups (optional)
+        :param aggregate: if True, model equivalent entities as one class with an integer count per group (optional)
+        :param resolution: dictionary[numerical variable] = bucket width when aggregating (optional)
+        :return:
+        """
+        super(MatrixPartitionModel, self).__init__(model_data, n_groups, name, symmetry_breaking, sizes, aggregate,
+                                                   resolution)
+        return
+
+    def get_tuples(self):
+        """
+        Indices of the categorical violation variables
+        :return: dictionary[variable] = list of tuples
+        """
+
+        tuples = dict()
+        for c in self.df.categorical:
+            tuples[c] = [(i, g) for (i, n) in self.df.categorical[c] for g in self.groups]
+
+        return tuples
+
+    def create_variables(self, tuples):
+        """
+
+        :param tuples:
+        :return:
+        """
+
+        # Position of each entity in the allocation array
+        self.position = dict([(e, k) for (k, e) in enumerate(self.entities)])
+
+        # Entity allocation variables: number of entities of each class in each group (binary without aggregation)
+        counts = numpy.array([self.count[e] for e in self.entities])
+        self.variables['x'] = self.matrix.add_variables(self.n_entities * len(self.groups), 0,
+                                                        numpy.repeat(counts, len(self.groups)), True)\
+            .reshape(self.n_entities, len(self.groups))
+
+        for c in self.df.categorical:
+            # Penalty variables for violating categorical constraints
+            self.variables[c] = dict(zip(tuples[c], self.matrix.add_variables(len(tuples[c]), 0, None).tolist()))
+
+        for v in self.df.numerical:
+            # Numerical variables
+            self.variables[v] = {'mean_min': self.matrix.add_variable(),
+                                 'mean_max': self.matrix.add_variable(),
+                                 'var_min': self.matrix.add_variable(0),
+                                 'var_max': self.matrix.add_variable(0)}
+        return
+
+    def create_objective_function(self, tuples):
+        """
+
+        :param tuples:
+        :return:
+        """
+
+        for v in self.df.numerical:
+            # Minimise mean and variance range
+            self.matrix.set_objective(self.variables[v]['mean_max'], 1.0 / self.df.numerical[v]['mean'])
+            self.matrix.set_objective(self.variables[v]['mean_min'], -1.0 / self.df.numerical[v]['mean'])
+            self.matrix.set_objective(self.variables[v]['var_max'], 1.0 / self.df.numerical[v]['var'])
+            self.matrix.set_objective(self.variables[v]['var_min'], -1.0 / self.df.numerical[v]['var'])
+
+        for c in self.df.categorical:
+            # Penalise violations
+            for i in tuples[c]:
+                self.matrix.set_objective(self.variables[c][i], 1e4)
+
+        return
+
+    def create_entity_constraints(self):
+        """
+
+        :return:
+        """
+
+        # Each entity can be assigned to one group
+        n_groups = len(self.groups)
+        self.matrix.add_constraints(numpy.repeat(numpy.arange(self.n_entities), n_groups),
+                                    self.variables['x'].ravel(), numpy.ones(self.n_entities * n_groups),
+                                    'E', [self.count[e] for e in self.entities])
+
+        return
+
+    def add_numerical_constraints(self):
+        """
+
+        :return:
+        """
+
+        values = self.df.data.columns
+        squared_deviations = dict([(v, self.get_squared_deviations(v)) for v in self.df.numerical])
+
+        for j, g in enumerate(self.groups):
+            x = self.variables['x'][:, j]
+
+            # Each group must contain a certain number of people
+            self.matrix.add_constraint(x, numpy.ones(self.n_entities), 'E', self.group_size[g])
+
+            for v in self.df.numerical:
+                # Each mean must be between some L.B. and U.B.
+                self.add_bound_constraint(x, values[v], self.variables[v]['mean_min'], -self.group_size[g], 'G')
+                self.add_bound_constraint(x, values[v], self.variables[v]['mean_max'], -self.group_size[g], 'L')
+
+                # Each variance must be between some L.B. and U.B.
+                #
+                #   Note: This is an approximation of the variance as we use global mean rather than
+                #       the sample mean (as this would be non-linear)
+                self.add_bound_constraint(x, squared_deviations[v], self.variables[v]['var_min'],
+                                          -self.group_size[g], 'G')
+                self.add_bound_constraint(x, squared_deviations[v], self.variables[v]['var_max'],
+                                          -self.group_size[g], 'L')
+
+        return
+
+    def add_bound_constraint(self, cols, values, bound, coefficient, sense, rhs=0):
+        """
+        Add the constraint sum(values * cols) + coefficient * bound (sense) rhs
+        :param cols: array of columns
+        :param values: array of coefficients of cols
+        :param bound: column of the bound variable
+        :param coefficient: coefficient of the bound variable
+        :param sense: 'L' (<=), 'G' (>=) or 'E' (==)
+        :param rhs: right hand side
+        :return:
+        """
+        self.matrix.add_constraint(numpy.append(cols, bound), numpy.append(values, coefficient), sense, rhs)
+        return
+
+    def add_categorical_constraints(self):
+        """
+        Adds the categorical constraints
+        :return:
+        """
+
+        # Positions of the entities at each level
+        positions = dict()
+        for c in self.df.categorical:
+            positions[c] = dict()
+            for (l, n) in self.df.categorical[c]:
+                positions[c][l] = self.df.data.get_level_positions(c, l)
+
+        # For each group
+        for j, g in enumerate(self.groups):
+            # For each categorical variable
+            for c in self.df.categorical:
+                # For each level in that variable
+                for (l, n) in self.df.categorical[c]:
+                    x = self.variables['x'][positions[c][l], j]
+                    ones = numpy.ones(len(x))
+
+                    # L.B.
+                    self.add_bound_constraint(x, ones, self.variables[c][(l, g)], 1, 'G',
+                                              int(n * self.group_size[g]))
+
+                    # U.B.
+                    self.add_bound_constraint(x, ones, self.variables[c][(l, g)], -1, 'L',
+                                              int(n * self.group_size[g]) + 1)
+
+        return
+
+    def add_symmetry_breaking_constraints(self):
+        """
+        Fixes the allocation variables that only appear in relabelled copies of other allocations
+        :return:
+        """
+
+        self.fixed = self.get_symmetric_assignments()
+        if self.fixed:
+            # The allocation variables are non-negative, so a zero sum fixes each of them to zero
+            cols = [self.variables['x'][k, j] for (k, j) in self.fixed]
+            self.constraints['symmetry'] = self.matrix.add_constraint(cols, numpy.ones(len(cols)), 'E', 0)
+
+        return
+
+    def remove_symmetry_breaking(self):
+        """
+        Frees the allocation variables fixed by add_symmetry_breaking_constraints, once the labels of the groups
+        matter. Rows cannot be removed from a SparseMatrix, so the zero sum becomes a sum of at most the numbers of
+        entities of the classes, which always holds
+        :return:
+        """
+
+        if self.fixed:
+            total = sum([self.count[self.entities[k]] for (k, j) in self.fixed])
+            self.matrix.change_constraint(self.constraints.pop('symmetry'), 'L', total)
+        self.fixed = list()
+        self.symmetry_breaking = False
+
+        return
+
+    def set_allocation(self, allocation):
+        """
+        Sets the values of the allocation variables. With symmetry breaking, the groups are relabelled so the
+        values satisfy it
+        :param allocation: dictionary[entity] = group
+        :return:
+        """
+
+        self.set_value(self.variables['x'], 0)
+
+        allocation = self.relabel(allocation)
+        self.last_allocation = allocation
+
+        j = dict([(g, i) for (i, g) in enumerate(self.groups)])
+        counts = numpy.zeros((self.n_entities, len(self.groups)))
+        for (e, g), n in self.get_class_counts(allocation).items():
+            counts[self.position[e], j[g]] = n
+        self.set_value(self.variables['x'], counts)
+
+        return
+
+    def update_entities(self, model_data, sizes=None):
+        """
+        The rows of a SparseMatrix are fixed once added, so entities cannot be updated and this raises ValueError.
+        Build a new model for the new set of entities instead
+        :param model_data: data class of the new set of entities
+        :param sizes: list of group sizes (optional)
+        :return:
+        """
+        raise ValueError('Entities cannot be updated in a MatrixPartitionModel, build a new model for the new entities')
+
+    def resolve(self, time_limit, previous, disruption=0, solver=None):
+        """
+        Entities cannot be updated in a MatrixPartitionModel, so there is nothing to resolve and this raises
+        ValueError. Solve a new model with the previous allocation as initial instead
+        :param time_limit: time limit (seconds)
+        :param previous: dictionary[entity] = group
+        :param disruption: objective cost of moving each entity of the previous allocation (optional)
+        :param solver: solver backend (optional)
+        :return:
+        """
+        raise ValueError('Entities cannot be updated in a MatrixPartitionModel, build a new model for the new entities')
+
+    def get_allocation_values(self):
+        """
+        Values of the allocation variables, read from the solution vector in one step
+        :return: array (entity position, group position) of values
+        """
+        return self.solution[self.variables['x']]
+
+
+class MatrixDistributionModel(DistributionModel, MatrixModel):
+    """
+    DistributionModel built as a SparseMatrix
+    """
+
+    def __init__(self, old_population, new_population, n_people, name='MatrixDistributionModel', aggregate=False,
+                 resolution=None):
+        """
+        Instantiates MatrixDistributionModel
+        :param old_population: data for population we wish to match
+        :param new_population: data for population we draw entities from
+        :param n_people: number of entities to select from new_population
+        :param name: name of match
+        :param aggregate: if True, model equivalent entities of new_population as one class with an integer count
+            of entities selected (optional)
+        :param resolution: dictionary[numerical variable] = bucket width when aggregating (optional)
+        :return:
+        """
+        super(MatrixDistributionModel, self).__init__(old_population, new_population, n_people, name, aggregate,
+                                                      resolution)
+        return
+
+    def create_variables(self):
+        """
+        Add the variables to the model
+        :return:
+        """
+
+        variables = dict()
+
+        # Entity variables
+        variables['x'] = self.matrix.add_variables(len(self.entities), 0,
+                                                   numpy.array([len(self.members[i]) for i in self.entities]), True)
+
+        # Categorical variables
+        for c in self.new_df.categorical:
+            levels = [a for a, b in self.new_df.categorical[c]]
+            variables[c] = dict(zip(levels, self.matrix.add_variables(len(levels), 0, None).tolist()))
+
+        # Numerical variables
+        for v in self.new_df.numerical:
+            variables[v] = dict()
+            for k in ['mean_p', 'mean_n', 'var_p', 'var_n']:
+                variables[v][k] = self.matrix.add_variable(0)
+        return variables
+
+    def create_objective_function(self):
+        """
+        Add objective function
+        :return:
+        """
+
+        for v in self.new_df.numerical:
+            # Difference between means and variances of each population
+            for k in ['mean_p', 'mean_n', 'var_p', 'var_n']:
+                self.matrix.set_objective(self.variables[v][k], 1.0)
+
+        # Penalise violations
+        for c in self.new_df.categorical:
+            for l in self.variables[c]:
+                self.matrix.set_objective(self.variables[c][l], 1e4)
+
+        return
+
+    def add_entity_constraints(self):
+        """
+        Adds entity constraints to model
+        :return:
+        """
+
+        self.matrix.add_constraint(self.variables['x'], numpy.ones(len(self.entities)), 'E', self.n_people)
+
+        return
+
+    def add_numeric_constraints(self):
+        """
+        Add the numeric constraints
+        :return:
+        """
+
+        x = self.variables['x']
+
+        # For each numeric variable
+        for v in self.new_df.numerical:
+            values = self.new_df.data.columns[v]
+            squared_deviations = pow(values - self.new_df.numerical[v]['mean'], 2)
+
+            # Make the means similar
+            self.matrix.add_constraint(numpy.append(x, [self.variables[v]['mean_p'], self.variables[v]['mean_n']]),
+                                       numpy.append(values / self.n_people, [-1, 1]),
+                                       'E', self.old_df.numerical[v]['mean'])
+
+            # Make the variances similar
+            self.matrix.add_constraint(numpy.append(x, [self.variables[v]['var_p'], self.variables[v]['var_n']]),
+                                       numpy.append(squared_deviations / self.n_people, [-1, 1]),
+                                       'E', self.old_df.numerical[v]['var'])
+
+        return
+
+    def add_categorical_constraints(self):
+        """
+        Add categorical constraints
+        :return:
+        """
+
+        # For each categorical variable
+        for c in self.new_df.categorical:
+            # For each level in that variable
+            for (l, n) in self.new_df.categorical[c]:
+                # Goal proportion
+                m = self.get_proportion(self.old_df.categorical[c], l)
+
+                x = self.variables['x'][self.new_df.data.get_level_positions(c, l)]
+                ones = numpy.ones(len(x))
+
+                # L.B.
+                self.matrix.add_constraint(numpy.append(x, self.variables[c][l]), numpy.append(ones, 1),
+                                           'G', int(m * self.n_people))
+
+                # U.B.
+                self.matrix.add_constraint(numpy.append(x, self.variables[c][l]), numpy.append(ones, -1),
+                                           'L', int(m * self.n_people) + 1)
+
+        return
+
+    def set_allocation(self, allocation):
+        """
+        Sets the values of the entity variables
+        :param allocation: list of selected entities
+        :return:
+        """
+
+        self.last_allocation = allocation
+
+        self.set_value(self.variables['x'], [n for (i, n) in self.get_class_counts(allocation)])
+
+        return
+
+    def extract_results(self):
+        """
+        Get assignment
+        :return:
+        """
+        counts = self.get_counts(self.solution[self.variables['x']])
+        return self.disaggregate([(self.entities[k], counts[k]) for k in numpy.nonzero(counts > 0)[0]])
+
+
+class RecursivePartitionModel(PartitionModel):
+    """
+    PartitionModel for very large problems, solved by recursive bisection.
+
+    The groups are split into branching parts, and the entities are partitioned into parts of the matching total
+    sizes with the PartitionModel objective. Each part is split again until every part is a single group. The
+    subproblems at each level are solved in parallel in a process pool.
+    """
+
+    def __init__(self, model_data, n_groups, name='RecursivePartitionModel', branching=2, processes=None,
+                 model_class=None):
+        """
+
+        :param model_data: data class
+        :param n_groups: number of groups to partition into
+        :param name: model name (optional)
+        :param branching: number of parts to split into at each level (optional)
+        :param processes: number of processes to solve subproblems with (optional, default number of cpus)
+        :param model_class: model class to solve subproblems with (optional, default MatrixPartitionModel)
+        :return:
+        """
+
+        # The full model is never built, so skip PartitionModel.__init__
+        Model.__init__(self, name)
+
+        self.df = SubsetData(model_data, model_data.data.keys())
+        self.entity_data = self.df
+
+        self.n_entities = len(self.df.data)
+        self.entities = self.df.data.keys()
+        self.variables = dict()
+
+        self.groups, self.group_size = self.create_groups(n_groups, self.n_entities)
+
+        self.branching = branching
+        self.processes = processes
+        self.model_class = MatrixPartitionModel if model_class is None else model_class
+
+        # dictionary[entity] = group
+        self.allocation = None
+
+        return
+
+    def get_key(self):
+        """
+        Data and parameters the solution of the model depends on
+        :return: list
+        """
+        return [get_data_fingerprint(self.entity_data), sorted(self.group_size.items()), self.branching,
+                self.model_class.__name__]
+
+    def update_entities(self, model_data, sizes=None):
+        """
+        The full model is never built, so there is nothing to update and this raises ValueError. Build a new model
+        for the new set of entities instead
+        :param model_data: data class of the new set of entities
+        :param sizes: list of group sizes (optional)
+        :return:
+        """
+        raise ValueError('Entities cannot be updated in a RecursivePartitionModel, build a new model for the new '
+                         'entities')
+
+    def resolve(self, time_limit, previous, disruption=0, solver=None):
+        """
+        Entities cannot be updated in a RecursivePartitionModel, so there is nothing to resolve and this raises
+        ValueError
+        :param time_limit: time limit (seconds)
+        :param previous: dictionary[entity] = group
+        :param disruption: objective cost of moving each entity of the previous allocation (optional)
+        :param solver: solver backend (optional)
+        :return:
+        """
+        raise ValueError('Entities cannot be updated in a RecursivePartitionModel, build a new model for the new '
+                         'entities')
+
+    def split_groups(self, groups):
+        """
+        Splits a list of groups into contiguous parts of near-equal length
+        :param groups: list of groups
+        :return: list of lists of groups
+        """
+
+        k = min(self.branching, len(groups))
+        return [groups[len(groups) * i / k:len(groups) * (i + 1) / k] for i in range(k)]
+
+    def get_depth(self):
+        """
+        Number of levels of splitting
+        :return: depth
+        """
+
+        depth = 0
+        parts = [self.groups]
+        while max([len(p) for p in parts]) > 1:
+            parts = [q for p in parts for q in self.split_groups(p)]
+            depth += 1
+        return depth
+
+    def solve(self, time_limit, solver=None, job=None):
+        """
+        Solve the model, splitting the time limit evenly between the levels
+        :param time_limit: time limit (seconds)
+        :param solver: solver backend for the subproblems (optional, default CBC)
+        :param job: SolveJob the solve runs in, which is checked for cancellation between levels (optional)
+        :return: tuple (allocation, quality)
+        """
+
+        level_time_limit = time_limit / float(max(self.get_depth(), 1))
+        processes = multiprocessing.cpu_count() if self.processes is None else self.processes
+
+        # Daemonic processes, e.g. the workers of solve_many, cannot start a pool, so the subproblems run in turn
+        if multiprocessing.current_process().daemon:
+            processes = 1
+
+        self.allocation = dict()
+        pool = None
+
+        try:
+            # Subproblems: tuple (entities, groups)
+            level = [(self.entities, self.groups)]
+
+            while level:
+                if job is not None:
+                    job.check()
+
+                tasks = list()
+                parts = list()
+
+                for entities, groups in level:
+                    if len(groups) == 1:
+                        for e in entities:
+                            self.allocation[e] = groups[0]
+                        continue
+                    split = self.split_groups(groups)
+                    sizes = [sum([self.group_size[g] for g in p]) for p in split]
+                    tasks.append([SubsetData(self.df, entities), sizes, None, self.model_class, solver])
+                    parts.append(split)
+
+                # With more subproblems than processes they run in several waves, which share the level's time
+                waves = (len(tasks) + processes - 1) / processes
+                for task in tasks:
+                    task[2] = level_time_limit / max(waves, 1)
+
+                if len(tasks) > 1 and processes > 1 and pool is None:
+                    pool = multiprocessing.Pool(processes)
+
+                if pool is not None and len(tasks) > 1:
+                    results = pool.map(solve_subproblem, tasks)
+                else:
+                    results = map(solve_subproblem, tasks)
+
+                level = list()
+                for split, task, result in zip(parts, tasks, results):
+                    for k, groups in enumerate(split):
+                        level.append(([e for e in task[0].data if result[e] == k + 1], groups))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        return self.process_solution()
+
+    def extract_results(self):
+        """
+
+        :return:
+        """
+
+        allocation = {'entity-group': dict(self.allocation), 'group-entity': dict()}
+
+        for e in self.entities:
+            g = self.allocation[e]
+            if g not in allocation['group-entity']:
+                allocation['group-entity'][g] = [e]
+            else:
+                allocation['group-entity'][g].append(e)
+
+        return allocation
+
+
+def solve_subproblem(task):
+    """
+    Partitions a subset of the entities into parts of given sizes.
+    At module level so it can be run in a process pool
+    :param task: tuple (data, list of part sizes, time limit, model class, solver backend)
+    :return: dictionary[entity] = part, numbered from 1
+    """
+
+    model_data, sizes, time_limit, model_class, solver = task
+    model = model_class(model_data, len(sizes), symmetry_breaking=True, sizes=sizes)
+    allocation, quality = model.solve(time_limit, solver=solver)
+    return allocation['entity-group']
+
+
+class Problem(object):
+    """
+    A model to build and solve, for solve_many
+    """
+
+    def __init__(self, key, model_class, args, time_limit, kwargs=None, solve_kwargs=None):
+        """
+        Instantiate Problem
+        :param key: key the result is reported with, e.g. the name of a cohort
+        :param model_class: model class, e.g. PartitionModel or MatrixDistributionModel
+        :param args: tuple of arguments of model_class, e.g. (data, n_groups)
+        :param time_limit: time limit of the solve (seconds)
+        :param kwargs: dictionary of keyword arguments of model_class (optional)
+        :param solve_kwargs: dictionary of keyword arguments of solve, e.g. {'solver': CBC(threads=1)} (optional)
+        :return:
+        """
+
+        self.key = key
+        self.model_class = model_class
+        self.args = args
+        self.time_limit = time_limit
+        self.kwargs = dict() if kwargs is None else kwargs
+        self.solve_kwargs = dict() if solve_kwargs is None else solve_kwargs
+
+        return
+
+
+def solve_problem(problem):
+    """
+    Builds and solves a Problem, catching any error so one failure does not stop the others.
+    At module level so it can be run in a process pool
+    :param problem: Problem
+    :return: tuple (key, allocation or None, quality or None, error message or None, seconds)
+    """
+
+    start = time.time()
+    try:
+        model = problem.model_class(*problem.args, **problem.kwargs)
+        allocation, quality = model.solve(problem.time_limit, **problem.solve_kwargs)
+    except Exception:
+        return problem.key, None, None, traceback.format_exc(), time.time() - start
+    return problem.key, allocation, quality, None, time.time() - start
+
+
+def solve_many(problems, processes=None, progress=None):
+    """
+    Builds and solves many independent models in a process pool, yielding the results as they complete.
+
+    Each process solves one model at a time, so at most processes solvers run at once. The models and their
+    data are sent to the processes by pickling. A problem that fails is reported with allocation None and the
+    error message in place of the quality.
+    :param problems: list of Problem
+    :param processes: number of processes (optional, default number of cpus)
+    :param progress: function called with (number completed, number of problems, key, seconds, error message or
+        None) as each problem completes (optional)
+    :return: generator of tuples (key, allocation, quality)
+    """
+
+    processes = multiprocessing.cpu_count() if processes is None else processes
+    pool = None
+
+    try:
+        if processes > 1 and len(problems) > 1:
+            pool = multiprocessing.Pool(min(processes, len(problems)))
+            results = pool.imap_unordered(solve_problem, problems)
+        else:
+            results = (solve_problem(problem) for problem in problems)
+
+        for completed, (key, allocation, quality, error, seconds) in enumerate(results, 1):
+            if progress is not None:
+                progress(completed, len(problems), key, seconds, error)
+            yield key, allocation, quality if error is None else error
+    finally:
+        if pool is not None:
+            # Also stops the solves still running if the generator is closed early
+            pool.terminate()
+            pool.join()
+
+    return
+
+
+class SwapSearch(object):
+    """
+    Local search for PartitionModel that needs no MIP solver.
+
+    Starts from a stratified round-robin allocation and improves it by swapping pairs of entities in different
+    groups. The objective is the one built in PartitionModel.create_objective_function, evaluated from group
+    sums, sums of squared deviations and level counts that are updated incrementally on each swap.
+    """
+
+    def __init__(self, model_data, groups, group_size, seed=None):
+        """
+        Instantiate SwapSearch
+        :param model_data: data class
+        :param groups: list of groups
+        :param group_size: dictionary[group] = number of entities
+        :param seed: random seed (optional)
+        :return:
+        """
+
+        self.df = model_data
+        self.groups = groups
+        self.size = [group_size[g] for g in groups]
+
+        self.random = random.Random(seed)
+
+        # Entities, and their numerical values and levels by position
+        self.entities = list(self.df.data.keys())
+        self.values = dict()
+        self.squared_deviations = dict()
+        for v in self.df.numerical:
+            u = self.df.numerical[v]['mean']
+            self.values[v] = self.df.data.columns[v].tolist()
+            self.squared_deviations[v] = pow(self.df.data.columns[v] - u, 2).tolist()
+        self.levels = dict()
+        for c in self.df.categorical:
+            self.levels[c] = self.df.data.column(c).tolist()
+
+        # Lower bound of the number of entities at each level in each group
+        self.targets = dict()
+        for c in self.df.categorical:
+            self.targets[c] = dict([(l, [int(n * size) for size in self.size]) for (l, n) in self.df.categorical[c]])
+
+        # Group of each entity, by position
+        self.assignment = None
+
+        # Group sums, sums of squared deviations and level counts
+        self.sums = None
+        self.squared_sums = None
+        self.counts = None
+
+        return
+
+    def initial_allocation(self):
+        """
+        Deals the entities, sorted by their levels and numerical values, round-robin into the groups
+        :return: list of group positions
+        """
+
+        def key(k):
+            return tuple([self.levels[c][k] for c in self.levels] + [self.values[v][k] for v in self.values])
+
+        assignment = [None] * len(self.entities)
+        space = list(self.size)
+
+        j = 0
+        for k in sorted(range(len(self.entities)), key=key):
+            # Skip the groups that are full
+            while space[j] == 0:
+                j = (j + 1) % len(self.groups)
+            assignment[k] = j
+            space[j] -= 1
+            j = (j + 1) % len(self.groups)
+
+        return assignment
+
+    def set_assignment(self, assignment):
+        """
+        Sets the allocation and rebuilds the group sums and level counts
+        :param assignment: list of group positions
+        :return:
+        """
+
+        self.assignment = list(assignment)
+
+        self.sums = dict()
+        self.squared_sums = dict()
+        for v in self.values:
+            self.sums[v] = [0.0] * len(self.groups)
+            self.squared_sums[v] = [0.0] * len(self.groups)
+            for k, j in enumerate(self.assignment):
+                self.sums[v][j] += self.values[v][k]
+                self.squared_sums[v][j] += self.squared_deviations[v][k]
+
+        self.counts = dict()
+        for c in self.levels:
+            self.counts[c] = dict([(l, [0] * len(self.groups)) for l in self.targets[c]])
+            for k, j in enumerate(self.assignment):
+                if self.levels[c][k] in self.counts[c]:
+                    self.counts[c][self.levels[c][k]][j] += 1
+
+        return
+
+    def get_violation(self, c, l, j):
+        """
+        Violation of the level constraints of PartitionModel.add_categorical_constraints
+        :param c: categorical variable
+        :param l: level
+        :param j: group position
+        :return: violation
+        """
+        n = self.counts[c][l][j]
+        return max(0, self.targets[c][l][j] - n, n - self.targets[c][l][j] - 1)
+
+    def get_numerical_objective(self):
+        """
+        Normalised ranges of the group means and variances
+        :return: objective value
+        """
+
+        obj = 0.0
+        for v in self.values:
+            means = [t / size for (t, size) in zip(self.sums[v], self.size)]
+            variances = [t / size for (t, size) in zip(self.squared_sums[v], self.size)]
+            obj += (max(means) - min(means)) / self.df.numerical[v]['mean']
+            obj += (max(variances) - min(variances)) / self.df.numerical[v]['var']
+        return obj
+
+    def get_categorical_objective(self, groups):
+        """
+        Penalty on the violations in some of the groups
+        :param groups: list of group positions
+        :return: objective value
+        """
+
+        obj = 0.0
+        for c in self.counts:
+            for l in self.counts[c]:
+                for j in groups:
+                    obj += 1e4 * self.get_violation(c, l, j)
+        return obj
+
+    def move(self, a, b):
+        """
+        Swaps the groups of two entities
+        :param a: position of first entity
+        :param b: position of second entity
+        :return:
+        """
+
+        g, h = self.assignment[a], self.assignment[b]
+
+        for v in self.values:
+            d = self.values[v][b] - self.values[v][a]
+            self.sums[v][g] += d
+            self.sums[v][h] -= d
+            d = self.squared_deviations[v][b] - self.squared_deviations[v][a]
+            self.squared_sums[v][g] += d
+            self.squared_sums[v][h] -= d
+
+        for c in self.levels:
+            la, lb = self.levels[c][a], self.levels[c][b]
+            if la != lb:
+                if la in self.counts[c]:
+                    self.counts[c][la][g] -= 1
+                    self.counts[c][la][h] += 1
+                if lb in self.counts[c]:
+                    self.counts[c][lb][h] -= 1
+                    self.counts[c][lb][g] += 1
+
+        self.assignment[a], self.assignment[b] = h, g
+
+        return
+
+    def search(self, time_limit, assignment=None):
+        """
+        Improves an allocation by pairwise swaps until no improving swap is found or the time limit is reached
+        :param time_limit: time limit (seconds)
+        :param assignment: list of group positions to start from (optional)
+        :return: dictionary[entity] = group
+        """
+
+        end = time.time() + time_limit
+
+        self.set_assignment(self.initial_allocation() if assignment is None else assignment)
+
+        n = len(self.entities)
+        obj = self.get_numerical_objective()
+
+        # Stop after this many swaps in a row fail to improve the objective
+        patience = max(1000, 10 * n)
+        failures = 0
+
+        while failures < patience and len(self.groups) > 1:
+            if failures % 100 == 0 and time.time() > end:
+                break
+
+            a = self.random.randrange(n)
+            b = self.random.randrange(n)
+            g, h = self.assignment[a], self.assignment[b]
+            if g == h:
+                failures += 1
+                continue
+
+            before = obj + self.get_categorical_objective([g, h])
+            self.move(a, b)
+            numerical = self.get_numerical_objective()
+
+            if numerical + self.get_categorical_objective([g, h]) < before - 1e-9:
+                obj = numerical
+                failures = 0
+            else:
+                # Undo
+                self.move(a, b)
+                failures += 1
+
+        return dict([(self.entities[k], self.groups[j]) for (k, j) in enumerate(self.assignment)])
+
+    def get_violations(self):
+        """
+        Violations of the level constraints in the current allocation
+        :return: dictionary[categorical][(level, group)] = violation
+        """
+
+        violations = dict()
+        for c in self.counts:
+            violations[c] = dict()
+            for l in self.counts[c]:
+                for j, g in enumerate(self.groups):
+                    violations[c][(l, g)] = self.get_violation(c, l, j)
+        return violations
+
+
+class SolverBackend(object):
+    """
+    Solver run as an executable on an MPS file
+    """
+
+    def __init__(self, path=None, threads=None, seed=None, gap=None):
+        """
+        Instantiate SolverBackend
+        :param path: path of the executable (optional)
+        :param threads: number of threads (optional)
+        :param seed: random seed (optional)
+        :param gap: relative optimality gap to stop at (optional)
+        :return:
+        """
+
+        self.path = self.get_default_path() if path is None else path
+        self.threads = threads
+        self.seed = seed
+        self.gap = gap
+
+        return
+
+    def get_default_path(self):
+        raise NotImplementedError
+
+    def get_key(self):
+        """
+        Settings the solution depends on, for Model.get_fingerprint
+        :return: tuple
+        """
+        return type(self).__name__, self.path, self.threads, self.seed, self.gap
+
+    def get_command(self, mps_file, time_limit, solution_file, mip_start_file=None):
+        raise NotImplementedError
+
+    def read_solution(self, solution_file, mps_file):
+        raise NotImplementedError
+
+    def available(self):
+        """
+        True if the executable can be run
+        :return: boolean
+        """
+        return self.path is not None and solvers.LpSolver_CMD.executable(self.path) is not False
+
+    def start(self, mps_file, time_limit, solution_file, mip_start_file=None):
+        """
+        Start the solver without waiting for it
+        :param mps_file: full filepath of MPS file
+        :param time_limit: time limit (seconds)
+        :param solution_file: full filepath the solution is written to
+        :param mip_start_file: full filepath of MIP start file (optional)
+        :return: process
+        """
+
+        if not self.available():
+            raise PulpSolverError('Cannot execute %s' % self.path)
+
+        # Line buffer the output where possible, so the log can be followed while the solver runs
+        command = self.get_command(mps_file, time_limit, solution_file, mip_start_file)
+        if os.name == 'posix' and solvers.LpSolver_CMD.executable('stdbuf'):
+            command = ['stdbuf', '-oL'] + command
+
+        # The log is kept next to the solution, for read_log
+        with open(solution_file + '.log', 'w') as pipe:
+            return subprocess.Popen(command, stdout=pipe, stderr=subprocess.STDOUT)
+
+    def solve(self, mps_file, time_limit, directory, mip_start_file=None, job=None, stats=None):
+        """
+        Solve an MPS file
+        :param mps_file: full filepath of MPS file
+        :param time_limit: time limit (seconds)
+        :param directory: directory for temporary files
+        :param mip_start_file: full filepath of MIP start file (optional)
+        :param job: SolveJob that can kill the solver process (optional)
+        :param stats: Stats to set the outcome of the solve in (optional)
+        :return: tuple (PuLP status, objective value or None, dictionary[column name] = value)
+        """
+
+        solution_file = os.path.join(directory, 'model.sol')
+        process = self.start(mps_file, time_limit, solution_file, mip_start_file)
+        if job is not None:
+            job.add_process(process)
+            job.follow(process, self, solution_file + '.log')
+        process.wait()
+
+        if not os.path.exists(solution_file):
+            raise PulpSolverError('Error while executing %s' % self.path)
+
+        result = self.read_solution(solution_file, mps_file)
+        if stats is not None:
+            stats.set_outcome(result[0], result[1], self.read_log(solution_file + '.log'))
+
+        return result
+
+    def read_log(self, log_file):
+        """
+        Best bound and number of nodes reported in the solver log
+        :param log_file: full filepath of log file
+        :return: dictionary of 'bound' and 'nodes', where reported
+        """
+        return dict()
+
+    def read_progress(self, line, progress):
+        """
+        Updates the progress of a running solve from a line of its log
+        :param line: line of the log
+        :param progress: dictionary of 'objective' (of the incumbent), 'bound' and 'nodes', where reported so far
+        :return:
+        """
+        return
+
+    @staticmethod
+    def read_mps_columns(mps_file):
+        """
+        Column names of an MPS file, in the order they appear
+        :param mps_file: full filepath of MPS file
+        :return: list of column names
+        """
+
+        columns = list()
+        with open(mps_file, 'r') as f:
+            section = None
+            for line in f:
+                if not line[0].isspace():
+                    section = line.split()[0]
+                    continue
+                items = line.split()
+                if section == 'COLUMNS' and items and items[1] != "'MARKER'" and \
+                        (not columns or columns[-1] != items[0]):
+                    columns.append(items[0])
+        return columns
+
+
+class CBC(SolverBackend):
+    """
+    COIN-OR CBC. The MIP start is passed with the mips command
+    """
+
+    def get_default_path(self):
+        """
+        Path of the CBC executable, falling back to the one that ships with PuLP
+        :return: path
+        """
+        solver = solvers.COIN_CMD()
+        if solver.available():
+            return solver.path
+        return solvers.PULP_CBC_CMD().path
+
+    def get_command(self, mps_file, time_limit, solution_file, mip_start_file=None):
+        """
+        Command line to solve an MPS file
+        :param mps_file: full filepath of MPS file
+        :param time_limit: time limit (seconds)
+        :param solution_file: full filepath the solution is written to
+        :param mip_start_file: full filepath of MIP start file (optional)
+        :return: list of arguments
+        """
+
+        # The time limit is wall-clock time, so runs sharing the processors still stop on time
+        args = [self.path, mps_file, 'timeMode', 'elapsed', 'sec', str(time_limit)]
+        if self.threads is not None:
+            args += ['threads', str(self.threads)]
+        if self.seed is not None:
+            args += ['randomCbcSeed', str(self.seed)]
+        if self.gap is not None:
+            args += ['ratio', str(self.gap)]
+        if mip_start_file is not None:
+            args += ['mips', mip_start_file]
+        args += ['branch', 'solution', solution_file]
+
+        return args
+
+    def read_solution(self, solution_file, mps_file):
+        """
+        Read a CBC solution file
+        :param solution_file: full filepath of solution file
+        :param mps_file: full filepath of MPS file
+        :return: tuple (PuLP status, objective value or None, dictionary[column name] = value)
+        """
+
+        cbc_status = {'Optimal': LpStatusOptimal,
+                      'Infeasible': LpStatusInfeasible,
+                      'Integer': LpStatusInfeasible,
+                      'Unbounded': LpStatusUnbounded,
+                      'Stopped': LpStatusNotSolved}
+
+        values = dict()
+
+        with open(solution_file, 'r') as f:
+            header = f.readline()
+            status = cbc_status.get(header.split()[0], LpStatusUndefined)
+            for line in f:
+                items = line.split()
+                if len(items) < 3:
+                    continue
+                # In case the solution is infeasible
+                if items[0] == '**':
+                    items = items[1:]
+                values[items[1]] = float(items[2])
+
+        # Stopped runs that found no integer solution report a huge objective, or the objective of the continuous
+        # relaxation, e.g. "Stopped on time (no integer solution - continuous used) - objective value 0.00000000"
+        objective = None
+        if 'objective value' in header:
+            objective = float(header.split('objective value')[1].split()[0])
+        if status in [LpStatusInfeasible, LpStatusUnbounded] or objective is None or objective >= 1e50 or \
+                'no integer solution' in header:
+            objective = None
+
+        return status, objective, values
+
+    def read_log(self, log_file):
+        """
+        Best bound and number of nodes from the summary at the end of a CBC log
+        :param log_file: full filepath of log file
+        :return: dictionary of 'bound' and 'nodes', where reported
+        """
+
+        log = dict()
+        with open(log_file, 'r') as f:
+            for line in f:
+                if line.startswith('Lower bound:'):
+                    log['bound'] = float(line.split(':')[1])
+                elif line.startswith('Enumerated nodes:'):
+                    log['nodes'] = int(line.split(':')[1])
+
+        return log
+
+    def read_progress(self, line, progress):
+        """
+        Updates the progress of a running solve from a line of the CBC log, e.g.
+        "Cbc0010I After 100 nodes, 12 on tree, 0.035 best solution, best possible 0 (2.50 seconds)"
+        :param line: line of the log
+        :param progress: dictionary of 'objective' (of the incumbent), 'bound' and 'nodes', where reported so far
+        :return:
+        """
+
+        number = r'([-+]?[0-9.]+(?:e[-+]?[0-9]+)?)'
+        match = re.search(r'Integer solution of ' + number, line) or re.search(number + ' best solution,', line)
+        if match and float(match.group(1)) < 1e50:
+            progress['objective'] = float(match.group(1))
+
+        match = re.search(r'best possible ' + number, line) or \
+            re.search(r'^Continuous objective value is ' + number, line)
+        if match:
+            progress['bound'] = float(match.group(1))
+
+        match = re.search(r'(?:After|and) (\d+) nodes', line)
+        if match:
+            progress['nodes'] = int(match.group(1))
+
+        return
+
+
+class GLPK(SolverBackend):
+    """
+    GNU GLPK (glpsol). The MIP start is not supported and is ignored
+    """
+
+    def get_default_path(self):
+        """
+        Path of glpsol
+        :return: path
+        """
+        return solvers.GLPK_CMD().path
+
+    def get_command(self, mps_file, time_limit, solution_file, mip_start_file=None):
+        """
+        Command line to solve an MPS file
+        :param mps_file: full filepath of MPS file
+        :param time_limit: time limit (seconds)
+        :param solution_file: full filepath the solution is written to
+        :param mip_start_file: ignored
+        :return: list of arguments
+        """
+
+        args = [self.path, '--freemps', mps_file, '--tmlim', str(int(time_limit))]
+        if self.seed is not None:
+            args += ['--seed', str(self.seed)]
+        if self.gap is not None:
+            args += ['--mipgap', str(self.gap)]
+        args += ['--write', solution_file]
+
+        return args
+
+    def read_solution(self, solution_file, mps_file):
+        """
+        Read a glpsol solution file (GLPK 4.57 and later). Columns are numbered in MPS file order
+        :param solution_file: full filepath of solution file
+        :param mps_file: full filepath of MPS file
+        :return: tuple (PuLP status, objective value or None, dictionary[column name] = value)
+        """
+
+        glpk_status = {'o': LpStatusOptimal,
+                       'f': LpStatusNotSolved,
+                       'n': LpStatusInfeasible,
+                       'u': LpStatusUndefined}
+
+        columns = self.read_mps_columns(mps_file)
+        status = LpStatusUndefined
+        objective = None
+        values = dict()
+
+        with open(solution_file, 'r') as f:
+            for line in f:
+                items = line.split()
+                if not items:
+                    continue
+                if items[0] == 's':
+                    status = glpk_status.get(items[4], LpStatusUndefined)
+                    if items[4] in ['o', 'f']:
+                        objective = float(items[5])
+                elif items[0] == 'j':
+                    values[columns[int(items[1]) - 1]] = float(items[-1])
+
+        return status, objective, values
+
+    def read_log(self, log_file):
+        """
+        Best bound from the last progress line of a GLPK log, "+ iterations: mip = objective >= bound ..."
+        :param log_file: full filepath of log file
+        :return: dictionary of 'bound', where reported
+        """
+
+        log = dict()
+        with open(log_file, 'r') as f:
+            for line in f:
+                items = line.split()
+                if 'mip' in items and '>=' in items:
+                    bound = items[items.index('>=') + 1]
+                    if 'inf' not in bound:
+                        log['bound'] = float(bound)
+
+        return log
+
+    def read_progress(self, line, progress):
+        """
+        Updates the progress of a running solve from a progress line of the GLPK log
+        :param line: line of the log
+        :param progress: dictionary of 'objective' (of the incumbent) and 'bound', where reported so far
+        :return:
+        """
+
+        items = line.split()
+        if 'mip' in items and '>=' in items:
+            objective = items[items.index('mip') + 2]
+            bound = items[items.index('>=') + 1]
+            if objective != 'not':
+                progress['objective'] = float(objective)
+            if 'inf' not in bound:
+                progress['bound'] = float(bound)
+
+        return
+
+
+class HiGHS(SolverBackend):
+    """
+    HiGHS (highs executable). The MIP start is not supported and is ignored
+    """
+
+    def get_default_path(self):
+        """
+        Path of highs
+        :return: path
+        """
+        return solvers.LpSolver_CMD.executableExtension('highs')
+
+    def get_command(self, mps_file, time_limit, solution_file, mip_start_file=None):
+        """
+        Command line to solve an MPS file
+        :param mps_file: full filepath of MPS file
+        :param time_limit: time limit (seconds)
+        :param solution_file: full filepath the solution is written to
+        :param mip_start_file: ignored
+        :return: list of arguments
+        """
+
+        args = [self.path, '--model_file', mps_file, '--time_limit', str(time_limit),
+                '--solution_file', solution_file]
+        if self.seed is not None:
+            args += ['--random_seed', str(self.seed)]
+
+        # Options without a command line flag
+        options = list()
+        if self.threads is not None:
+            options.append('threads = %d' % self.threads)
+        if self.gap is not None:
+            options.append('mip_rel_gap = %s' % self.gap)
+        if options:
+            options_file = solution_file + '.opt'
+            with open(options_file, 'w') as f:
+                f.write('\n'.join(options) + '\n')
+            args += ['--options_file', options_file]
+
+        return args
+
+    def read_solution(self, solution_file, mps_file):
+        """
+        Read a HiGHS solution file
+        :param solution_file: full filepath of solution file
+        :param mps_file: full filepath of MPS file
+        :return: tuple (PuLP status, objective value or None, dictionary[column name] = value)
+        """
+
+        highs_status = {'Optimal': LpStatusOptimal,
+                        'Infeasible': LpStatusInfeasible,
+                        'Unbounded': LpStatusUnbounded,
+                        'Time limit reached': LpStatusNotSolved}
+
+        status = LpStatusUndefined
+        objective = None
+        values = dict()
+
+        with open(solution_file, 'r') as f:
+            lines = [line.strip() for line in f]
+
+        for k, line in enumerate(lines):
+            if line.startswith('Model status'):
+                # Either "Model status : X" or "Model status" followed by X
+                text = line.split(':', 1)[1] if ':' in line else lines[k + 1]
+                status = highs_status.get(text.strip(), LpStatusUndefined)
+            elif line.startswith('Objective') and objective is None:
+                objective = float(line.split()[-1])
+            elif line.startswith('# Columns') and not values:
+                for item in lines[k + 1:k + 1 + int(line.split()[-1])]:
+                    name, value = item.split()[:2]
+                    values[name] = float(value)
+
+        if status in [LpStatusInfeasible, LpStatusUnbounded] or not values:
+            objective = None
+
+        return status, objective, values
+
+    def read_log(self, log_file):
+        """
+        Best bound and number of nodes from the solving report at the end of a HiGHS log
+        :param log_file: full filepath of log file
+        :return: dictionary of 'bound' and 'nodes', where reported
+        """
+
+        log = dict()
+        with open(log_file, 'r') as f:
+            for line in f:
+                items = line.split()
+                if items[:2] == ['Dual', 'bound'] and len(items) > 2:
+                    log['bound'] = float(items[2])
+                elif items[:1] == ['Nodes'] and len(items) > 1:
+                    log['nodes'] = int(items[1])
+
+        return log
+
+    def read_progress(self, line, progress):
+        """
+        Updates the progress of a running solve from a line of the HiGHS branch and bound table, e.g.
+        " L       0       0         0   0.00%   0.012           0.0163            26.38% ...", where the columns are
+        the source of the solution (if any), nodes processed, nodes in queue, leaves, explored, best bound, best
+        solution and gap
+        :param line: line of the log
+        :param progress: dictionary of 'objective' (of the incumbent), 'bound' and 'nodes', where reported so far
+        :return:
+        """
+
+        match = re.match(r'^\s*(?:[A-Za-z]\s+)?(\d+)\s+\d+\s+\d+\s+[0-9.]+%\s+(\S+)\s+(\S+)', line)
+        if not match:
+            return
+
+        progress['nodes'] = int(match.group(1))
+        if 'inf' not in match.group(2):
+            progress['bound'] = float(match.group(2))
+        if 'inf' not in match.group(3):
+            progress['objective'] = float(match.group(3))
+
+        return
+
+
+class Portfolio(object):
+    """
+    Races several solver backends on the same MPS file at once.
+
+    Each backend runs as its own process. The first run that proves optimality stops the others, otherwise the
+    best incumbent found within the time limit is returned.
+    """
+
+    def __init__(self, backends):
+        """
+        Instantiate Portfolio
+        :param backends: list of solver backends, e.g. [CBC(seed=1), CBC(seed=2), HiGHS()]
+        :return:
+        """
+
+        # Backends that are not installed are left out
+        self.backends = [b for b in backends if b.available()]
+
+        return
+
+    def available(self):
+        """
+        True if any of the backends can be run
+        :return: boolean
+        """
+        return len(self.backends) > 0
+
+    def get_key(self):
+        """
+        Settings the solution depends on, for Model.get_fingerprint
+        :return: tuple
+        """
+        return type(self).__name__, [b.get_key() for b in self.backends]
+
+    def solve(self, mps_file, time_limit, directory, mip_start_file=None, job=None, stats=None):
+        """
+        Solve an MPS file with all the backends at once
+        :param mps_file: full filepath of MPS file
+        :param time_limit: time limit (seconds)
+        :param directory: directory for temporary files
+        :param mip_start_file: full filepath of MIP start file (optional)
+        :param job: SolveJob that can kill the solver processes (optional)
+        :param stats: Stats to set the outcome of the best run in (optional)
+        :return: tuple (PuLP status, objective value or None, dictionary[column name] = value)
+        """
+
+        if not self.available():
+            raise PulpSolverError('No solver in the portfolio is available')
+
+        running = list()
+        for k, backend in enumerate(self.backends):
+            solution_file = os.path.join(directory, 'portfolio_%d.sol' % k)
+            running.append((backend, solution_file,
+                            backend.start(mps_file, time_limit, solution_file, mip_start_file)))
+            if job is not None:
+                job.add_process(running[-1][2])
+                job.add_log(backend, solution_file + '.log')
+
+        # Allow the solvers a little longer than the time limit to write their solutions
+        end = time.time() + time_limit + 5
+        best = (LpStatusNotSolved, None, dict())
+        best_run = None
+        next_progress = time.time()
+
+        while running:
+            for run in list(running):
+                backend, solution_file, process = run
+                if process.poll() is None:
+                    continue
+
+                running.remove(run)
+                if not os.path.exists(solution_file):
+                    continue
+
+                result = backend.read_solution(solution_file, mps_file)
+                if result[1] is not None and (best[1] is None or result[1] < best[1]):
+                    best = result
+                    best_run = run
+
+                if result[0] == LpStatusOptimal:
+                    # Proven optimal, so stop the others
+                    for other in running:
+                        other[2].kill()
+                        other[2].wait()
+                    running = list()
+                    break
+
+            if job is not None and time.time() >= next_progress:
+                job.update_progress()
+                next_progress = time.time() + job.interval
+
+            if running and time.time() > end:
+                for backend, solution_file, process in running:
+                    process.kill()
+                    process.wait()
+                running = list()
+
+            time.sleep(0.05)
+
+        if stats is not None:
+            log = dict() if best_run is None else best_run[0].read_log(best_run[1] + '.log')
+            stats.set_outcome(best[0], best[1], log)
+
+        return best
+
+
+class SolveCancelled(Exception):
+    """
+    Raised by the result of a SolveJob that was cancelled
+    """
+    pass
+
+
+class SolveJob(object):
+    """
+    A model solved in a background thread.
+
+    While the solver runs, its log is read every interval seconds into the progress of the job: the objective of
+    the incumbent, the best bound, the gap, the number of nodes and the nodes per second, where the solver reports
+    them (CBC and HiGHS report all, GLPK the objective and bound). With a Portfolio, the best incumbent and bound of
+    all the runs are reported. Once the solve is done, the progress is the outcome of the solve, as in model.stats.
+
+    Stopping the job interrupts the solver, which then writes its incumbent, so result returns the best
+    allocation found so far. Cancelling the job kills its solver processes instead. The solve then stops with its
+    temporary files removed, as for any failed solve, and result raises SolveCancelled.
+    """
+
+    def __init__(self, model, time_limit, kwargs, semaphore, callback=None, interval=1.0):
+        """
+        Instantiate SolveJob and start its thread
+        :param model: model to solve
+        :param time_limit: time limit (seconds)
+        :param kwargs: dictionary of keyword arguments of solve
+        :param semaphore: semaphore held while solving, which limits the solves running at once
+        :param callback: function called from the job's thread with the progress dictionary whenever it changes
+            (optional)
+        :param interval: seconds between reads of the solver log (optional)
+        :return:
+        """
+
+        self.model = model
+        self.time_limit = time_limit
+        self.kwargs = kwargs
+        self.semaphore = semaphore
+        self.callback = callback
+        self.interval = interval
+
+        # Solver processes started for the job, and whether it was stopped or cancelled
+        self.processes = list()
+        self.stopped = False
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+        # Logs being read: list of [backend, log file, bytes read, unfinished line, progress of the log]
+        self.logs = list()
+        self.start_time = None
+        self.progress = dict()
+
+        # Result, or the error raised by the solve
+        self.value = None
+        self.error = None
+        self.finished = threading.Event()
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+        return
+
+    def run(self):
+        """
+        Solves the model once fewer solves than the limit are running
+        :return:
+        """
+
+        try:
+            # Wait for a place, unless cancelled in the meantime
+            while not self.semaphore.acquire(False):
+                self.check()
+                time.sleep(0.05)
+
+            try:
+                self.check()
+                self.start_time = time.time()
+                self.value = self.model.solve(self.time_limit, job=self, **self.kwargs)
+                self.check()
+
+                # Only where a solver ran, so the outcome is that of this solve
+                if self.logs and self.model.stats.solver:
+                    self.finish_progress()
+            finally:
+                self.semaphore.release()
+        except SolveCancelled as error:
+            self.error = error
+        except Exception as error:
+            self.error = SolveCancelled('Solve cancelled') if self.cancelled else error
+        finally:
+            self.finished.set()
+
+        return
+
+    def add_process(self, process):
+        """
+        Registers a solver process, which is killed at once if the job was cancelled
+        :param process: process
+        :return:
+        """
+
+        with self.lock:
+            self.processes.append(process)
+            if self.cancelled:
+                self.kill(process)
+            elif self.stopped:
+                self.interrupt(process)
+
+        return
+
+    def add_log(self, backend, log_file):
+        """
+        Registers the log of a solver process, to be read into the progress
+        :param backend: solver backend writing the log
+        :param log_file: full filepath of log file
+        :return:
+        """
+        self.logs.append([backend, log_file, 0, '', dict()])
+        return
+
+    def follow(self, process, backend, log_file):
+        """
+        Reads the log of a solver process into the progress until the process exits
+        :param process: process
+        :param backend: solver backend writing the log
+        :param log_file: full filepath of log file
+        :return:
+        """
+
+        self.add_log(backend, log_file)
+        while process.poll() is None:
+            self.finished.wait(self.interval)
+            self.update_progress()
+        self.update_progress()
+
+        return
+
+    def update_progress(self):
+        """
+        Reads the new lines of the logs, and calls the callback if the progress changed
+        :return:
+        """
+
+        for log in self.logs:
+            backend, log_file, offset, unfinished, progress = log
+            try:
+                with open(log_file, 'r') as f:
+                    f.seek(offset)
+                    text = unfinished + f.read()
+                    log[2] = f.tell()
+            except IOError:
+                continue
+
+            # The last line may be only partly written
+            lines = text.split('\n')
+            log[3] = lines.pop()
+            for line in lines:
+                backend.read_progress(line, progress)
+
+        # Best incumbent and bound over the logs, as the objective is minimised
+        objectives = [log[4]['objective'] for log in self.logs if 'objective' in log[4]]
+        bounds = [log[4]['bound'] for log in self.logs if 'bound' in log[4]]
+        nodes = [log[4]['nodes'] for log in self.logs if 'nodes' in log[4]]
+        seconds = time.time() - self.start_time
+
+        self.set_progress(min(objectives) if objectives else None, max(bounds) if bounds else None,
+                          sum(nodes) if nodes else None)
+
+        return
+
+    def set_progress(self, objective, bound, nodes):
+        """
+        Sets the progress, and calls the callback if it changed
+        :param objective: objective of the incumbent, or None
+        :param bound: best bound, or None
+        :param nodes: number of nodes, or None
+        :return:
+        """
+
+        seconds = time.time() - self.start_time
+        progress = {'objective': objective, 'bound': bound, 'gap': get_gap(objective, bound), 'nodes': nodes,
+                    'node_rate': None if nodes is None or seconds <= 0 else nodes / seconds, 'seconds': seconds}
+
+        changed = [progress[k] for k in ['objective', 'bound', 'nodes']] != \
+            [self.progress.get(k) for k in ['objective', 'bound', 'nodes']]
+        self.progress = progress
+        if changed and self.callback is not None:
+            self.callback(dict(progress))
+
+        return
+
+    def finish_progress(self):
+        """
+        Replaces the progress read from the logs with the outcome of the solve, read from the solution and the
+        summary at the end of the log, e.g. the bound of a solve proven optimal
+        :return:
+        """
+
+        outcome = self.model.stats.solver
+        nodes = outcome.get('nodes')
+        self.set_progress(outcome.get('objective'), outcome.get('bound'),
+                          self.progress.get('nodes') if nodes is None else nodes)
+
+        return
+
+    def get_progress(self):
+        """
+        Latest progress of the solver, or its outcome once the solve is done
+        :return: dictionary of 'objective' (of the incumbent), 'bound', 'gap', 'nodes', 'node_rate' and 'seconds',
+            None where not reported
+        """
+        return dict(self.progress)
+
+    @staticmethod
+    def interrupt(process):
+        """
+        Interrupts a process if it is still running, as with Ctrl-C. Solvers stop and write their incumbent.
+        Windows has no such signal for a single process, so the process is killed there
+        :param process: process
+        :return:
+        """
+
+        if process.poll() is None:
+            try:
+                if os.name == 'nt':
+                    process.kill()
+                else:
+                    process.send_signal(signal.SIGINT)
+            except OSError:
+                # Finished in the meantime
+                pass
+
+        return
+
+    def stop(self):
+        """
+        Stops the solver early. The job finishes with the best allocation found so far, if any
+        :return: True if the job was not already done
+        """
+
+        with self.lock:
+            if self.finished.is_set():
+                return False
+            self.stopped = True
+            for process in self.processes:
+                self.interrupt(process)
+
+        return True
+
+    @staticmethod
+    def kill(process):
+        """
+        Kills a process if it is still running
+        :param process: process
+        :return:
+        """
+
+        if process.poll() is None:
+            try:
+                process.kill()
+            except OSError:
+                # Finished in the meantime
+                pass
+
+        return
+
+    def check(self):
+        """
+        Raises SolveCancelled if the job was cancelled
+        :return:
+        """
+
+        if self.cancelled:
+            raise SolveCancelled('Solve cancelled')
+
+        return
+
+    def cancel(self):
+        """
+        Cancels the job, killing its solver processes. A job waiting to start never starts
+        :return: True if the job was not already done
+        """
+
+        with self.lock:
+            if self.finished.is_set():
+                return False
+            self.cancelled = True
+            for process in self.processes:
+                self.kill(process)
+
+        return True
+
+    def done(self):
+        """
+        True if the job has finished, failed or been cancelled
+        :return: boolean
+        """
+        return self.finished.is_set()
+
+    def result(self, timeout=None):
+        """
+        Waits for the job to finish
+        :param timeout: seconds to wait (optional, default no limit)
+        :return: tuple (allocation, quality)
+        """
+
+        if not self.finished.wait(timeout):
+            raise RuntimeError('Solve still running after %s seconds' % timeout)
+        if self.error is not None:
+            raise self.error
+
+        return self.value
+
+
+class SolveExecutor(object):
+    """
+    Starts SolveJobs, with at most a given number solving at once and the others waiting their turn
+    """
+
+    def __init__(self, max_solves=None):
+        """
+        Instantiate SolveExecutor
+        :param max_solves: number of solves running at once (optional, default number of cpus)
+        :return:
+        """
+
+        self.max_solves = multiprocessing.cpu_count() if max_solves is None else max_solves
+        self.semaphore = threading.BoundedSemaphore(self.max_solves)
+
+        return
+
+    def submit(self, model, time_limit, callback=None, **kwargs):
+        """
+        Starts solving a model in the background
+        :param model: model to solve
+        :param time_limit: time limit (seconds)
+        :param callback: function called with the progress of the solver as it changes (optional)
+        :param kwargs: keyword arguments of solve, e.g. initial or solver
+        :return: SolveJob
+        """
+        return SolveJob(model, time_limit, kwargs, self.semaphore, callback)
+
+
+# Executor of Model.solve_async, shared by all models
+solve_executor = SolveExecutor()
+
+
+class ResultCache(object):
+    """
+    Results of earlier solves kept on disk, one file per fingerprint of the data, model and solve arguments.
+
+    When the files grow over the size limit, the least recently used results are removed
+    """
+
+    def __init__(self, directory, max_bytes=2 ** 30):
+        """
+        Instantiate ResultCache
+        :param directory: directory to keep the results in
+        :param max_bytes: size limit of the results (optional, default 1 GB)
+        :return:
+        """
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        return
+
+    def get_path(self, key):
+        """
+        File of a result
+        :param key: fingerprint from Model.get_fingerprint
+        :return: full filepath
+        """
+        return os.path.join(self.directory, '%s.pickle' % key)
+
+    def get(self, key):
+        """
+        Stored result, marked as just used
+        :param key: fingerprint from Model.get_fingerprint
+        :return: tuple (allocation, quality), or None if not stored
+        """
+
+        path = self.get_path(key)
+        try:
+            with open(path, 'rb') as f:
+                result = pickle.load(f)
+        except IOError:
+            return None
+        except (EOFError, pickle.UnpicklingError):
+            # Left incomplete, so solved again
+            self.invalidate(key)
+            return None
+
+        os.utime(path, None)
+
+        return result
+
+    def put(self, key, result):
+        """
+        Stores a result, then removes the least recently used results over the size limit
+        :param key: fingerprint from Model.get_fingerprint
+        :param result: tuple (allocation, quality)
+        :return:
+        """
+
+        # Written to a temporary file first, so a result is never read half written
+        handle, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(handle, 'wb') as f:
+            pickle.dump(result, f, 2)
+        self.invalidate(key)
+        os.rename(temporary, self.get_path(key))
+
+        self.evict()
+
+        return
+
+    def evict(self):
+        """
+        Removes the least recently used results until the rest fit in the size limit
+        :return:
+        """
+
+        entries = list()
+        for name in os.listdir(self.directory):
+            if name.endswith('.pickle'):
+                status = os.stat(os.path.join(self.directory, name))
+                entries.append((status.st_mtime, status.st_size, name))
+
+        total = sum([size for (used, size, name) in entries])
+        for used, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+        return
+
+    def invalidate(self, key):
+        """
+        Removes a result
+        :param key: fingerprint from Model.get_fingerprint
+        :return: True if the result was stored
+        """
+
+        try:
+            os.remove(self.get_path(key))
+        except OSError:
+            return False
+
+        return True
+
+    def clear(self):
+        """
+        Removes all the results
+        :return:
+        """
+
+        for name in os.listdir(self.directory):
+            if name.endswith('.pickle') or name.endswith('.tmp'):
+                os.remove(os.path.join(self.directory, name))
+
+        return
+
+    def solve(self, model, time_limit, **kwargs):
+        """
+        Result of solving a model, from the cache if the same data, model and arguments were solved before
+        :param model: model to solve
+        :param time_limit: time limit (seconds)
+        :param kwargs: keyword arguments of solve, e.g. initial or solver
+        :return: tuple (allocation, quality)
+        """
+
+        key = model.get_fingerprint(time_limit, **kwargs)
+
+        result = self.get(key)
+        if result is not None:
+            logger.info('%s: result %s read from cache', model.stats.name, key)
+            return result
+
+        result = model.solve(time_limit, **kwargs)
+        self.put(key, result)
+
+        return result
+
+# ===================================================================================================================
+# ===================================================================================================================
+# ===================================================================================================================
+# ===================================================================================================================
+
+
+class EntityTable(collections.Mapping):
+    """
+    Columnar table of entity data, produced by the data classes and read by the models.
+
+    Holds an array of entity IDs, a float array for each numerical variable and, for each categorical variable, an
+    array of integer codes with a dictionary of the level of each code. For code written against the old format it
+    also reads as dictionary[entity][variable] = value, building each row on request.
+    """
+
+    def __init__(self, ids, numerical=None, categorical=None):
+        """
+        Instantiate EntityTable
+        :param ids: list of entity IDs
+        :param numerical: dictionary[variable] = list (or array) of values, in the order of ids
+        :param categorical: dictionary[variable] = list of levels, in the order of ids, or tuple (array of codes,
+            dictionary[code] = level)
+        :return:
+        """
+
+        numerical = dict() if numerical is None else numerical
+        categorical = dict() if categorical is None else categorical
+
+        # Entity IDs
+        self.ids = numpy.array(ids, dtype=object)
+        if self.ids.ndim != 1:
+            # Tuple IDs were unpacked into a second dimension, so fill one by one
+            self.ids = numpy.empty(len(ids), dtype=object)
+            for k, e in enumerate(ids):
+                self.ids[k] = e
+
+        # dictionary[entity] = position
+        self.position = dict(zip(ids, xrange(len(ids))))
+
+        # dictionary[numerical variable] = array of values
+        self.columns = dict([(v, numpy.asarray(numerical[v], dtype=float)) for v in numerical])
+
+        # dictionary[categorical variable] = array of codes, and dictionary[categorical variable][code] = level
+        self.codes = dict()
+        self.levels = dict()
+        for c in categorical:
+            if isinstance(categorical[c], tuple):
+                codes, self.levels[c] = categorical[c]
+            else:
+                codes, self.levels[c] = self.encode(categorical[c])
+            self.codes[c] = numpy.asarray(codes, dtype=int)
+
+        return
+
+    def get_fingerprint(self):
+        """
+        Hash of the contents of the table
+        :return: hex digest
+        """
+
+        digest = hashlib.sha1(repr(self.ids.tolist()))
+        for v in sorted(self.columns):
+            digest.update(repr(v))
+            digest.update(numpy.ascontiguousarray(self.columns[v]).tobytes())
+        for c in sorted(self.codes):
+            digest.update(repr((c, sorted(self.levels[c].items()))))
+            digest.update(numpy.ascontiguousarray(self.codes[c]).tobytes())
+
+        return digest.hexdigest()
+
+    @staticmethod
+    def encode(values):
+        """
+        Integer codes of a list of levels, numbered in order of first appearance
+        :param values: list of levels
+        :return: tuple (list of codes, dictionary[code] = level)
+        """
+
+        code = dict()
+        codes = [code.setdefault(l, len(code)) for l in values]
+        return codes, dict([(k, l) for (l, k) in code.items()])
+
+    def __getitem__(self, entity):
+        """
+        Row of an entity
+        :param entity: entity ID
+        :return: dictionary[variable] = value
+        """
+
+        k = self.position[entity]
+        row = dict([(v, float(self.columns[v][k])) for v in self.columns])
+        for c in self.codes:
+            row[c] = self.levels[c][self.codes[c][k]]
+        return row
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, entity):
+        return entity in self.position
+
+    def column(self, variable):
+        """
+        Values of a variable, in the order of the entities
+        :param variable: numerical or categorical variable
+        :return: array of values (levels for a categorical variable)
+        """
+
+        if variable in self.columns:
+            return self.columns[variable]
+
+        levels = numpy.empty(len(self.levels[variable]), dtype=object)
+        for k in self.levels[variable]:
+            levels[k] = self.levels[variable][k]
+        return levels[self.codes[variable]]
+
+    def get_positions(self, entities):
+        """
+        Positions of a list of entities
+        :param entities: list of entity IDs
+        :return: array of positions
+        """
+        return numpy.array([self.position[e] for e in entities], dtype=int)
+
+    def take(self, entities):
+        """
+        Table of a subset of the entities. The level codes are shared with this table
+        :param entities: list of entity IDs
+        :return: EntityTable
+        """
+
+        positions = self.get_positions(entities)
+        return EntityTable(list(entities),
+                           dict([(v, self.columns[v][positions]) for v in self.columns]),
+                           dict([(c, (self.codes[c][positions], self.levels[c])) for c in self.codes]))
+
+    def get_level_positions(self, c, level):
+        """
+        Positions of the entities at a level of a categorical variable
+        :param c: categorical variable
+        :param level: level
+        :return: array of positions
+        """
+
+        for k in self.levels[c]:
+            if self.levels[c][k] == level:
+                return numpy.nonzero(self.codes[c] == k)[0]
+        return numpy.zeros(0, dtype=int)
+
+    def get_level_index(self, c):
+        """
+        Entities at each level of a categorical variable
+        :param c: categorical variable
+        :return: dictionary[level] = list of entities
+        """
+
+        # Positions sorted by code, cut where the code changes
+        order = numpy.argsort(self.codes[c], kind='mergesort')
+        counts = numpy.bincount(self.codes[c], minlength=len(self.levels[c]))
+        ends = numpy.cumsum(counts)
+
+        return dict([(self.levels[c][k], self.ids[order[ends[k] - counts[k]:ends[k]]].tolist())
+                     for k in self.levels[c] if counts[k] > 0])
+
+    def get_level_counts(self, c):
+        """
+        Number of entities at each level of a categorical variable
+        :param c: categorical variable
+        :return: dictionary[level] = number of entities
+        """
+
+        counts = numpy.bincount(self.codes[c], minlength=len(self.levels[c]))
+        return dict([(self.levels[c][k], int(counts[k])) for k in self.levels[c] if counts[k] > 0])
+
+    def get_statistics(self, v):
+        """
+        Count, mean and variance of a numerical variable
+        :param v: numerical variable
+        :return: Statistics
+        """
+        return Statistics(self.columns[v])
+
+
+def get_data_fingerprint(model_data):
+    """
+    Hash of the entity data of a data class, with the numerical metrics and level proportions the models are
+    built from (which SubsetData takes from the full data)
+    :param model_data: data class
+    :return: hex digest
+    """
 
-        for v in self.new_df.numerical:
-            # Difference between means of each population
-            obj += self.variables[v]['mean_p'] + self.variables[v]['mean_n']
+    numerical = sorted([(v, sorted(model_data.numerical[v].items())) for v in model_data.numerical])
+    categorical = sorted([(c, sorted(model_data.categorical[c])) for c in model_data.categorical])
 
-            # Difference between the variance of each population
-            obj += self.variables[v]['var_p'] + self.variables[v]['var_n']
+    return hashlib.sha1(repr([model_data.data.get_fingerprint(), numerical, categorical])).hexdigest()
 
-        # Penalise violations
-        obj += 1e4 * lpSum([self.variables[c] for c in self.new_df.categorical])
 
-        # TODO: weightings on variables
+class Statistics(object):
+    """
+    Count, mean and variance of a set of values, accumulated in one pass.
 
-        # Add to model
-        self.model += obj
+    Keeps the count, the mean and the sum of squared deviations from the mean. Values are added (or removed) a batch
+    at a time, and two Statistics are merged without revisiting their values (Chan et al.), so batches that are read
+    separately, or in parallel, can be combined.
+    """
 
-        return
+    # Values are added in blocks of this many, which fit in the CPU cache
+    block = 65536
 
-    def add_entity_constraints(self):
+    def __init__(self, values=None):
         """
-        Adds entity constraints to model
+        Instantiate Statistics
+        :param values: list or array of values to add (optional)
         :return:
         """
 
-        self.model += lpSum([self.variables['x'][i] for i in self.entities]) == self.n_people
+        # Number of values, mean and sum of squared deviations from the mean
+        self.n = 0
+        self.mean = 0.0
+        self.squares = 0.0
+
+        if values is not None:
+            self.add(values)
 
         return
 
-    def add_numeric_constraints(self):
+    def combine(self, n, mean, squares):
         """
-        Add the numeric constraints
+        Merges the statistics of another set of values into these
+        :param n: number of values
+        :param mean: mean of the values
+        :param squares: sum of squared deviations of the values from their mean
         :return:
         """
 
-        # For each numeric variable
-        for v in self.new_df.numerical:
-            # Make the means similar
-            self.model += lpSum([self.new_df.data[i][v] * self.variables['x'][i] for i in self.new_df.data]) \
-                / self.n_people - self.old_df.numerical[v]["mean"] \
-                == self.variables[v]['mean_p'] - self.variables[v]['mean_n']
+        total = self.n + n
+        if total == 0:
+            return
 
-            # Make the variances similar
-            self.model += lpSum([pow(self.new_df.data[i][v] - self.new_df.numerical[v]['mean'], 2)
-                                * self.variables['x'][i] for i in self.new_df.data]) / self.n_people - \
-                self.old_df.numerical[v]['var'] \
-                == self.variables[v]['var_p'] - self.variables[v]['var_n']
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.squares += squares + pow(delta, 2) * self.n * n / total
+        self.n = total
 
         return
 
-    @staticmethod
-    def get_proportion(my_list, level):
+    def add(self, values):
         """
-        gets proportion from list of tuples (level, proportion)
-        :param my_list: list of tuples from categorical variable
-        :param level: level of categorical variable
-        :return: proportion
+        Adds values
+        :param values: list or array of values
+        :return: self
         """
 
-        # For each tuple in list
-        for l, n in my_list:
-            if level == l:
-                # Return proportion
-                return n
+        values = numpy.asarray(values, dtype=float).ravel()
 
-        # Level not in list
-        return 0.0
+        for start in range(0, len(values), self.block):
+            x = values[start:start + self.block]
+            u = float(x.mean())
+            self.combine(len(x), u, float(pow(x - u, 2).sum()))
 
-    def add_categorical_constraints(self):
+        return self
+
+    def remove(self, values):
         """
-        Add categorical constraints
-        :return:
+        Removes values that were added before
+        :param values: list or array of values
+        :return: self
         """
 
-        # For each categorical variable
-        for c in self.new_df.categorical:
-            # For each level in that variable
-            for (l, n) in self.new_df.categorical[c]:
-                # Goal proportion
-                m = self.get_proportion(self.old_df.categorical[c], l)
+        removed = Statistics(values)
 
-                # L.B.
-                self.model += lpSum([self.variables['x'][i] for i in self.new_df.data if self.new_df.data[i][c] == l])\
-                    + self.variables[c][l] >= int(m * self.n_people)
+        total = self.n - removed.n
+        if total <= 0:
+            self.n, self.mean, self.squares = 0, 0.0, 0.0
+            return self
 
-                # U.B.
-                self.model += lpSum([self.variables['x'][i] for i in self.new_df.data if self.new_df.data[i][c] == l])\
-                    - self.variables[c][l] <= int(m * self.n_people) + 1
+        mean = (self.n * self.mean - removed.n * removed.mean) / total
+        delta = removed.mean - mean
+        self.squares = max(self.squares - removed.squares - pow(delta, 2) * total * removed.n / self.n, 0.0)
+        self.mean = mean
+        self.n = total
 
-        return
+        return self
 
-    def extract_results(self):
+    def merge(self, other):
         """
-        Get assignment
-        :return:
+        Adds the values of another Statistics
+        :param other: Statistics
+        :return: self
         """
-        return [i for i in self.variables['x'] if self.variables['x'][i].value() == 1]
 
-    def get_numerical_solution_quality(self):
+        self.combine(other.n, other.mean, other.squares)
+        return self
+
+    def get_var(self, ddof=0):
         """
-        Get statistical metrics about numerical variables
-        :return:
+        Variance
+        :param ddof: 0 to divide by the number of values, 1 for the sample variance (optional)
+        :return: variance, or None if there are not more than ddof values
         """
 
-        quality = dict()
-
-        for v in self.new_df.numerical:
+        if self.n <= ddof:
+            return None
+        return self.squares / (self.n - ddof)
 
-            quality[v] = dict()
 
-            quality[v]['mean'] = self.variables[v]['mean_p'].value() + self.variables[v]['mean_n'].value()
-            quality[v]['var'] = self.variables[v]['var_p'].value() + self.variables[v]['var_n'].value()
+class ConnectionPool(object):
+    """
+    Pool of open database connections, shared by DataBase instances.
 
-        return quality
+    Connections are opened on first use, with any DB-API 2.0 module, and kept by driver and connection arguments.
+    A connection that is released goes back to the pool, so later loads from the same server reuse it. Used as a
+    context manager, the pool closes every connection it holds on exit.
+    """
 
-    def get_categorical_solution_quality(self):
+    def __init__(self):
         """
-        Get statistical metrics of categorical solution quality
+        Instantiate ConnectionPool
         :return:
         """
 
-        quality = dict()
+        # dictionary[key] = list of idle connections
+        self.idle = dict()
 
-        for c in self.new_df.categorical:
-            quality[c] = dict()
+        self.lock = threading.Lock()
 
-            for (l, n) in self.new_df.categorical[c]:
-                quality[c][l] = self.variables[c][l].value()
+        return
 
-        return quality
+    @staticmethod
+    def get_key(driver, args, kwargs):
+        """
+        Key of the connections opened by driver.connect(*args, **kwargs)
+        :param driver: DB-API 2.0 module
+        :param args: tuple of positional connection arguments
+        :param kwargs: dictionary of keyword connection arguments
+        :return: key
+        """
+        return driver.__name__, tuple(args), tuple(sorted(kwargs.items()))
+
+    def acquire(self, driver, *args, **kwargs):
+        """
+        An idle connection with these arguments, or a new one if there is none
+        :param driver: DB-API 2.0 module, e.g. pyodbc, sqlite3 or psycopg2
+        :param args: positional arguments of driver.connect
+        :param kwargs: keyword arguments of driver.connect
+        :return: connection
+        """
+
+        key = self.get_key(driver, args, kwargs)
+
+        with self.lock:
+            if self.idle.get(key):
+                return self.idle[key].pop()
 
-    def get_solution_quality(self):
+        return driver.connect(*args, **kwargs)
+
+    def release(self, connection, driver, *args, **kwargs):
         """
-        get quality report
+        Returns a connection to the pool, ending its transaction
+        :param connection: connection from acquire
+        :param driver: DB-API 2.0 module it was acquired with
+        :param args: positional arguments it was acquired with
+        :param kwargs: keyword arguments it was acquired with
         :return:
         """
 
-        return {
-            'numerical': self.get_numerical_solution_quality(),
-            'categorical': self.get_categorical_solution_quality()}
+        connection.rollback()
 
-    def process_solution(self):
+        with self.lock:
+            self.idle.setdefault(self.get_key(driver, args, kwargs), list()).append(connection)
+
+        return
+
+    def close(self):
         """
-        get results and build quality report
+        Closes the idle connections
         :return:
         """
 
-        allocation = self.extract_results()
-        quality = self.get_solution_quality()
+        with self.lock:
+            connections = [c for key in self.idle for c in self.idle[key]]
+            self.idle = dict()
 
-        return allocation, quality
+        for connection in connections:
+            connection.close()
+
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
 
-# ===================================================================================================================
-# ===================================================================================================================
-# ===================================================================================================================
-# ===================================================================================================================
+
+# Pool used by DataBase when none is given
+connection_pool = ConnectionPool()
 
 
 class DataBase(object):
@@ -580,7 +4360,7 @@ class DataBase(object):
     """
 
     def __init__(self, server, database, entity_table, classification_table,
-                 uid=None, pwd=None, where=None):
+                 uid=None, pwd=None, where=None, batch_size=10000, driver=None, connect_args=None, pool=None):
         """
         Instantiate database class
         :param server: location of SQL server
@@ -594,36 +4374,127 @@ class DataBase(object):
         :param uid: username for SQL database
         :param pwd: password for SQL database
         :param where: optional where clause for selecting entity data
+        :param batch_size: number of rows fetched from the server at a time (optional)
+        :param driver: DB-API 2.0 module to connect with, e.g. sqlite3 or psycopg2 (optional, default pyodbc)
+        :param connect_args: dictionary of keyword arguments of driver.connect (optional, default database,
+            host, user and password from database, server, uid and pwd; with pyodbc, a SQL Server connection string)
+        :param pool: ConnectionPool to take the connection from (optional, default the shared connection_pool)
         :return: instance of database class
         """
-        if uid is not None:
-            # If password specified
-            connection_string = 'DRIVER={SQL Server}; SERVER=%s;DATABASE=%s;UID=%s;PWD=%s' \
-                                % (server, database, uid, pwd)
+
+        if driver is None:
+            if pyodbc is None:
+                raise ImportError('DataBase needs pyodbc, or another DB-API 2.0 module given as driver')
+            driver = pyodbc
+
+        if connect_args is not None:
+            self.connect_args = ((), connect_args)
+        elif driver is pyodbc:
+            if uid is not None:
+                # If password specified
+                connection_string = 'DRIVER={SQL Server}; SERVER=%s;DATABASE=%s;UID=%s;PWD=%s' \
+                                    % (server, database, uid, pwd)
+            else:
+                # Otherwise
+                connection_string = 'DRIVER={SQL Server}; SERVER=%s;DATABASE=%s' % (server, database)
+            self.connect_args = ((connection_string,), dict())
         else:
-            # Otherwise
-            connection_string = 'DRIVER={SQL Server}; SERVER=%s;DATABASE=%s' % (server, database)
+            self.connect_args = ((), dict([(k, a) for (k, a) in [('database', database), ('host', server),
+                                                                 ('user', uid), ('password', pwd)]
+                                           if a is not None]))
 
-        # Create connection
-        self.con = pyodbc.connect(connection_string)
+        # Driver, and the pool connections are taken from
+        self.driver = driver
+        self.pool = connection_pool if pool is None else pool
 
-        # Create cursor
-        self.cursor = self.con.cursor()
+        # Connection and cursor, while connected
+        self.con = None
+        self.cursor = None
+
+        # Number of rows fetched at a time
+        self.batch_size = batch_size
+
+        # Time and memory of each phase of the load
+        self.stats = Stats('DataBase')
+
+        with self.stats.phase('query'), self.connect():
+            # Classification of variables
+            classification = self.get_categories(classification_table)
+
+            # Entity Data, and Numerical Variable Data calculated as it is read
+            self.data, self.numerical = self.get_entity_table(entity_table, classification, where_clause=where)
 
-        # Classification of variables
-        classification = self.get_categories(classification_table)
+        with self.stats.phase('level index'):
+            # Entities at each level of the categorical variables
+            self.level_index = self.get_level_index(classification['categorical'])
 
-        # Entity Data
-        self.data = self.get_table(entity_table, where_clause=where)
+            # Categorical Variable Data
+            self.categorical = self.get_category_levels(classification['categorical'])
 
-        # Categorical Variable Data
-        self.categorical = self.get_category_levels(entity_table, classification['categorical'])
+        return
+
+    def __getstate__(self):
+        """
+        State for pickling, e.g. to send the data to a worker process of solve_many.
+        The driver is kept by name and connections are taken from the shared connection_pool after unpickling
+        :return: dictionary of attributes
+        """
+
+        state = dict(self.__dict__)
+        state['driver'] = self.driver.__name__
+        del state['pool']
+
+        return state
+
+    def __setstate__(self, state):
+        """
+        Restores the state from pickling
+        :param state: dictionary of attributes
+        :return:
+        """
 
-        # Numerical Variable Data
-        self.numerical = self.get_numerical_metrics(entity_table, classification['numerical'])
+        self.__dict__.update(state)
+        self.driver = __import__(state['driver'], fromlist=['connect'])
+        self.pool = connection_pool
 
         return
 
+    @contextlib.contextmanager
+    def connect(self):
+        """
+        Takes a connection from the pool for the queries in a with block, and returns it afterwards.
+        A connection that fails is closed rather than returned
+        :return: context manager
+        """
+
+        args, kwargs = self.connect_args
+        self.con = self.pool.acquire(self.driver, *args, **kwargs)
+        self.cursor = self.con.cursor()
+
+        try:
+            yield self
+        except Exception:
+            self.con.close()
+            raise
+        else:
+            self.cursor.close()
+            self.pool.release(self.con, self.driver, *args, **kwargs)
+        finally:
+            self.con = None
+            self.cursor = None
+
+    def fetch_batches(self):
+        """
+        Rows of the last query executed, fetched batch_size rows at a time
+        :return: generator of lists of rows
+        """
+
+        while True:
+            rows = self.cursor.fetchmany(self.batch_size)
+            if not rows:
+                return
+            yield rows
+
     def get_table(self, table_name, where_clause=None):
         """
         Method for turning table into python dictionary
@@ -646,12 +4517,73 @@ class DataBase(object):
         # Get list of columns
         cols = [column[0] for column in self.cursor.description]
 
-        for row in self.cursor.fetchall():
-            # add data
-            table_data[row[0]] = dict(zip(cols[1:], row[1:]))
+        for rows in self.fetch_batches():
+            for row in rows:
+                # add data
+                table_data[row[0]] = dict(zip(cols[1:], row[1:]))
 
         return table_data
 
+    def get_entity_table(self, table_name, classification, where_clause=None):
+        """
+        Method for reading the entity table into an EntityTable.
+        Rows are fetched in batches, each turned into one array per column, and the mean and variance of each
+        numerical variable are updated batch by batch
+        :param table_name: name of entity table
+        :param classification: dictionary containing lists of categorical and numerical variables
+        :param where_clause: optional clause to limit rows returned.
+        :return: tuple (EntityTable, dictionary[numerical variable][metric (mean/var)] = value)
+        """
+
+        numerical_variables = classification['numerical']
+        categorical_variables = classification['categorical']
+
+        # Create sql command
+        sql_command = "select * from %s" % table_name
+        if where_clause is not None:
+            sql_command += ' where ' + where_clause
+
+        # Execute command
+        self.cursor.execute(sql_command)
+
+        # Position of each column
+        cols = dict([(column[0], k) for (k, column) in enumerate(self.cursor.description)])
+
+        # Arrays of each batch, and the levels of the codes
+        ids = list()
+        numerical = dict([(v, list()) for v in numerical_variables])
+        codes = dict([(c, list()) for c in categorical_variables])
+        levels = dict([(c, dict()) for c in categorical_variables])
+
+        # Statistics of the rows so far
+        statistics = dict([(v, Statistics()) for v in numerical_variables])
+
+        for rows in self.fetch_batches():
+            ids.extend([row[0] for row in rows])
+
+            for v in numerical_variables:
+                values = numpy.array([row[cols[v]] for row in rows], dtype=float)
+                numerical[v].append(values)
+                statistics[v].add(values)
+
+            for c in categorical_variables:
+                # Code each level by its order of first appearance
+                code = levels[c]
+                codes[c].append(numpy.array([code.setdefault(row[cols[c]], len(code)) for row in rows], dtype=int))
+
+        # Sample variance, as the SQL var() aggregate
+        numeric_data = dict([(v, {'mean': statistics[v].mean if statistics[v].n else None,
+                                  'var': statistics[v].get_var(1)}) for v in numerical_variables])
+
+        table = EntityTable(ids,
+                            dict([(v, numpy.concatenate(numerical[v] or [numpy.zeros(0)]))
+                                  for v in numerical_variables]),
+                            dict([(c, (numpy.concatenate(codes[c] or [numpy.zeros(0, dtype=int)]),
+                                       dict([(k, l) for (l, k) in levels[c].items()])))
+                                  for c in categorical_variables]))
+
+        return table, numeric_data
+
     def get_categories(self, table):
         """
         Gets list of categorical and numerical variables from table
@@ -674,66 +4606,51 @@ class DataBase(object):
                 variables['numerical'].append(v)
         return variables
 
-    def get_category_levels(self, table, categorical_variables):
+    def get_level_index(self, categorical_variables):
+        """
+        Builds an index of the entities at each level of each categorical variable
+        :param categorical_variables: list of categorical variables
+        :return: dictionary[variable][level] = list of entities
+        """
+        return dict([(c, self.data.get_level_index(c)) for c in categorical_variables])
+
+    def get_category_levels(self, categorical_variables):
         """
         This function gets a list of levels and proportions for each categorical variable
-        :param table:   name of entity table
         :param categorical_variables: list of categorical variables
         :return: dictionary[categorical] = list of tuples (level, proportion)
         """
 
-        # Number of entities
-        n = len(self.data)
-
         category_data = dict()
 
-        # For each categorical variable
         for v in categorical_variables:
-
-            category_data[v] = list()
-
-            # SQL query to get counts
-            sql_command = "select %s, count(1) from %s group by %s" % (v, table, v)
-
-            # For each level
-            for row in self.cursor.execute(sql_command):
-                # Add data (level, proportion)
-                category_data[v].append((row[0], float(row[1]) / n))
+            counts = self.data.get_level_counts(v)
+            category_data[v] = [(l, float(counts[l]) / len(self.data)) for l in counts]
 
         return category_data
 
     def get_numerical_metrics(self, table, numerical_variables):
         """
-        Get the numerical metrics for data
-        :param table:   name of entity table
+        Get the numerical metrics for data, kept for compatibility. The metrics of the entity table are computed as
+        it is read, in self.numerical
+        :param table: name of entity table
         :param numerical_variables: list of numerical variables
-        :return:
+        :return: dictionary[variable][metric (mean/var)] = value
         """
 
-        numeric_data = dict()
-
-        # Get the mean and variance of each variable
-        metrics = ['mean', 'var']
-
-        for v in numerical_variables:
-            # SQL Query to get mean and variance of each variable
-            sql_command = "select avg(%s), var(%s) from %s" % (v, v, table)
-
-            # This should only return one row
-            for row in self.cursor.execute(sql_command):
-                # Zip into dictionary item
-                numeric_data[v] = dict(zip(metrics, row))
-
-        return numeric_data
+        with self.connect():
+            return self.get_entity_table(table, {'numerical': list(numerical_variables), 'categorical': list()})[1]
 
 
 class FlatFile(object):
 
-    def __init__(self, classification_filepath, entity_filepath, delimiter="\t"):
+    def __init__(self, classification_filepath, entity_filepath, delimiter="\t", cache_directory=None):
         """
         Instantiate FlatFile class
         :param classification_filepath: full filepath of classification text file
         :param entity_filepath: full filepath of entity text file
+        :param cache_directory: directory to keep the parsed data in, so later loads of the same files skip
+            parsing (optional)
         :return:
         """
 
@@ -746,91 +4663,217 @@ class FlatFile(object):
         # Delimiter to use
         self.delimiter = delimiter
 
-        # Get categories
-        classification = self.get_categories()
+        # Rows of the entity file parsed per second
+        self.rows_per_second = None
+
+        # Directory of the cached parsed data of these files
+        self.cache_path = None
+        if cache_directory is not None:
+            self.cache_path = os.path.join(cache_directory, self.get_fingerprint())
+
+        # Time and memory of each phase of the load
+        self.stats = Stats('FlatFile')
+
+        if self.cache_path is not None and os.path.isdir(self.cache_path):
+            # Get categories and data from the cache
+            with self.stats.phase('read cache'):
+                classification = self.read_cache(self.cache_path)
+        else:
+            # Get categories
+            classification = self.get_categories()
+
+            # Get data
+            with self.stats.phase('parse'):
+                self.data = self.read_file(self.entity_filepath, classification['numerical'],
+                                           classification['categorical'])
+
+            with self.stats.phase('metrics'):
+                # Get categorical variable data
+                self.categorical = self.get_category_levels(classification['categorical'])
+
+                # Get numerical variable data
+                self.numerical = self.get_numerical_metrics(classification['numerical'])
+
+            if self.cache_path is not None:
+                with self.stats.phase('write cache'):
+                    self.write_cache(self.cache_path, classification)
+
+        # Get entities at each level of the categorical variables
+        with self.stats.phase('level index'):
+            self.level_index = self.get_level_index(classification['categorical'])
+        return
+
+    def get_fingerprint(self):
+        """
+        Key of the cached data: changes whenever either file is moved, resized or modified, or the delimiter changes
+        :return: hex digest
+        """
+
+        key = [self.delimiter]
+        for filepath in [self.classification_filepath, self.entity_filepath]:
+            status = os.stat(filepath)
+            key.append((os.path.abspath(filepath), status.st_size, status.st_mtime))
+
+        return hashlib.sha1(repr(key)).hexdigest()
+
+    def write_cache(self, path, classification):
+        """
+        Saves the parsed data, as .npy files for the arrays and a pickle for the rest.
+        Written to a temporary directory first, so a partly written cache is never read
+        :param path: cache directory of these files
+        :param classification: dictionary containing lists of categorical and numerical variables
+        :return:
+        """
 
-        # Get data
-        self.data = self.read_file(self.entity_filepath, classification['numerical'])
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
 
-        # Get categorical variable data
-        self.categorical = self.get_category_levels(classification['categorical'])
+        directory = tempfile.mkdtemp(dir=os.path.dirname(path))
+
+        try:
+            numpy.save(os.path.join(directory, 'ids.npy'), numpy.array(self.data.ids.tolist()))
+            for k, v in enumerate(classification['numerical']):
+                numpy.save(os.path.join(directory, 'numerical_%d.npy' % k), self.data.columns[v])
+            for k, c in enumerate(classification['categorical']):
+                numpy.save(os.path.join(directory, 'categorical_%d.npy' % k), self.data.codes[c])
+
+            with open(os.path.join(directory, 'metadata.pickle'), 'wb') as f:
+                pickle.dump({'classification': classification, 'levels': self.data.levels,
+                             'categorical': self.categorical, 'numerical': self.numerical}, f, 2)
+
+            os.rename(directory, path)
+        except OSError:
+            # Another process wrote the cache first
+            if not os.path.isdir(path):
+                raise
+        finally:
+            if os.path.isdir(directory):
+                shutil.rmtree(directory)
 
-        # Get numerical variable data
-        self.numerical = self.get_numerical_metrics(classification['numerical'])
         return
 
+    def read_cache(self, path):
+        """
+        Loads the parsed data saved by write_cache. The arrays are memory-mapped rather than read
+        :param path: cache directory of these files
+        :return: dictionary containing lists of categorical and numerical variables
+        """
+
+        with open(os.path.join(path, 'metadata.pickle'), 'rb') as f:
+            metadata = pickle.load(f)
+
+        classification = metadata['classification']
+
+        def load(name):
+            return numpy.load(os.path.join(path, name), mmap_mode='r')
+
+        self.data = EntityTable(load('ids.npy').tolist(),
+                                dict([(v, load('numerical_%d.npy' % k))
+                                      for (k, v) in enumerate(classification['numerical'])]),
+                                dict([(c, (load('categorical_%d.npy' % k), metadata['levels'][c]))
+                                      for (k, c) in enumerate(classification['categorical'])]))
+
+        self.categorical = metadata['categorical']
+        self.numerical = metadata['numerical']
+
+        return classification
+
     def get_categories(self):
         """
 
         :return:
         """
         variables = {'categorical': list(), 'numerical': list()}
-        with open(self.classification_filepath, 'r') as f:
-            f.readline()
-            while True:
-                items = self.split_next_line(f)
-                if items is None:
-                    break
+        with open(self.classification_filepath, 'rb') as f:
+            reader = csv.reader(f, delimiter=self.delimiter)
+            reader.next()
+            for items in reader:
+                if not items:
+                    # Blank line
+                    continue
                 if int(items[1]) == 1:
-                    variables['categorical'].append(items[0])
+                    variables['categorical'].append(items[0].strip())
                 else:
-                    variables['numerical'].append(items[0])
+                    variables['numerical'].append(items[0].strip())
         return variables
 
     def split_next_line(self, f):
         """
-        Read next line, parse and split into list
+        Read next line, parse and split into list, kept for compatibility. read_file parses the whole file with a
+        single reader
         :param f: file pointer
-        :return: list of values
+        :return: list of values, or None at the end of the file
         """
 
-        # get next line
         line = f.readline()
-
         if not line:
             # EOF
             return None
 
-        # Get rid of new line characters etc
-        line = line.strip()
-
-        # Split into items
-        items = csv.reader([line], delimiter=self.delimiter).next()
-
-        return items
+        return csv.reader([line.strip()], delimiter=self.delimiter).next()
 
-    def read_file(self, filename, numerical_variables):
+    def read_file(self, filename, numerical_variables, categorical_variables):
         """
-        This function reads a csv and turns it into a dictionary, indexed by first column
+        This function reads a csv into an EntityTable, with the first column as the entity IDs.
+        The file is parsed in one pass by a single reader, which converts numerical variables to floats and
+        categorical variables to integer codes as it goes
         :param filename: full filepath of file
         :param numerical_variables: list of numerical variable names
-        :return: dictionary[index][variable] = value
+        :param categorical_variables: list of categorical variable names
+        :return: EntityTable
         """
 
-        file_data = dict()
+        # Values are collected in typed arrays, which hold numbers unboxed
+        ids = list()
+        numerical = dict([(v, array.array('d')) for v in numerical_variables])
+        codes = dict([(c, array.array('l')) for c in categorical_variables])
+        levels = dict([(c, dict()) for c in categorical_variables])
 
-        with open(filename, 'r') as f:
+        start = time.time()
+
+        with open(filename, 'rb') as f:
+            reader = csv.reader(f, delimiter=self.delimiter)
 
             # Read headers
-            headers = self.split_next_line(f)
+            headers = [h.strip() for h in reader.next()]
 
-            while True:
-                # Get next line
-                items = self.split_next_line(f)
+            # Positions of the variables
+            position = dict([(h, k) for (k, h) in enumerate(headers)])
+            columns = [(position[v], numerical[v].append) for v in numerical_variables]
+            coders = [(position[c], codes[c].append, levels[c]) for c in categorical_variables]
 
-                if items is None:
-                    # EOF
-                    break
+            for items in reader:
+                if not items:
+                    # Blank line
+                    continue
 
-                # Zip into dictionary
-                file_data[items[0]] = dict(zip(headers, items))
+                ids.append(items[0])
 
-        # make sure numerical variables are floats instead of strings
-        for v in numerical_variables:
-            for i in file_data:
-                file_data[i][v] = float(file_data[i][v])
+                # make sure numerical variables are floats instead of strings
+                for (k, append) in columns:
+                    append(float(items[k]))
+
+                # Code each level by its order of first appearance
+                for (k, append, code) in coders:
+                    append(code.setdefault(items[k], len(code)))
 
-        return file_data
+        # Parsing speed
+        self.rows_per_second = len(ids) / max(time.time() - start, 1e-6)
+
+        # The arrays are used as they are, without copying
+        numerical = dict([(v, numpy.frombuffer(numerical[v], dtype=float)) for v in numerical_variables])
+        categorical = dict([(c, (numpy.frombuffer(codes[c], dtype=int), dict([(k, l) for (l, k) in levels[c].items()])))
+                            for c in categorical_variables])
+
+        return EntityTable(ids, numerical, categorical)
+
+    def get_level_index(self, categorical_variables):
+        """
+        Builds an index of the entities at each level of each categorical variable
+        :param categorical_variables: list of categorical variables
+        :return: dictionary[variable][level] = list of entities
+        """
+        return dict([(c, self.data.get_level_index(c)) for c in categorical_variables])
 
     def get_category_levels(self, categorical_variables):
         """
@@ -839,23 +4882,11 @@ class FlatFile(object):
         :return: dictionary[variable] = list of tuples (level, proportion)
         """
 
-        cat = dict()
-        for c in categorical_variables:
-            cat[c] = dict()
-
-        for i in self.data:
-            for c in cat:
-                if self.data[i][c] in cat[c]:
-                    cat[c][self.data[i][c]] += 1
-                else:
-                    cat[c][self.data[i][c]] = 1
-
         categorical = dict()
 
-        for c in cat:
-            categorical[c] = list()
-            for l in cat[c]:
-                categorical[c].append((l, cat[c][l]))
+        for c in categorical_variables:
+            counts = self.data.get_level_counts(c)
+            categorical[c] = [(l, float(counts[l]) / len(self.data)) for l in counts]
 
         return categorical
 
@@ -871,11 +4902,99 @@ class FlatFile(object):
         # For each numerical variable
         for v in numerical_variables:
 
-            # calculate the mean
-            numerical[v] = {'mean': sum([self.data[i][v] for i in self.data]) / len(self.data)}
-
-            # calculate the variance
-            numerical[v]['var'] = sum([pow(self.data[i][v] - numerical[v]['mean'], 2) for i in self.data])\
-                / len(self.data)
+            # calculate the mean and variance
+            statistics = self.data.get_statistics(v)
+            numerical[v] = {'mean': statistics.mean, 'var': statistics.get_var()}
 
         return numerical
+
+
+class SubsetData(object):
+    """
+    Data of a subset of the entities of a data class, in the same format.
+
+    Level proportions are those of the subset. The numerical means and variances are those of the full data, so
+    every subset is balanced against the same targets.
+    """
+
+    def __init__(self, model_data, entities):
+        """
+        Instantiate SubsetData
+        :param model_data: data class
+        :param entities: list of entities
+        :return:
+        """
+
+        self.data = model_data.data.take(entities)
+
+        self.numerical = model_data.numerical
+
+        self.level_index = dict()
+        self.categorical = dict()
+        for c in model_data.level_index:
+            self.level_index[c] = self.data.get_level_index(c)
+            self.categorical[c] = [(l, float(len(self.level_index[c][l])) / len(entities))
+                                   for l in self.level_index[c]]
+
+        return
+
+
+class AggregateData(object):
+    """
+    Data of a data class with equivalent entities merged into classes, in the same format.
+
+    Entities are equivalent if they have the same levels and the same numerical values, after rounding down to a
+    multiple of the resolution of each variable. Each class takes the mean numerical values of its members. Level
+    proportions and numerical means and variances are those of the source data.
+    """
+
+    def __init__(self, model_data, resolution=None):
+        """
+        Instantiate AggregateData
+        :param model_data: data class
+        :param resolution: dictionary[numerical variable] = bucket width (optional, default exact values)
+        :return:
+        """
+
+        resolution = dict() if resolution is None else resolution
+
+        categorical_variables = sorted(model_data.level_index.keys())
+        numerical_variables = sorted(model_data.numerical.keys())
+
+        table = model_data.data
+
+        # Class key of each entity: its level codes and (bucketed) numerical values
+        key = [table.codes[c].tolist() for c in categorical_variables]
+        for v in numerical_variables:
+            if resolution.get(v):
+                key.append(numpy.floor(table.columns[v] / resolution[v]).astype(int).tolist())
+            else:
+                key.append(table.columns[v].tolist())
+
+        # Class of each entity, numbered in order of first appearance
+        classes = dict()
+        label = numpy.array([classes.setdefault(k, len(classes)) for k in zip(*key)], dtype=int)
+
+        # Entities sorted by class, and where each class starts and ends
+        order = numpy.argsort(label, kind='mergesort')
+        size = numpy.bincount(label, minlength=len(classes))
+        ends = numpy.cumsum(size)
+        starts = ends - size
+
+        # dictionary[class] = list of entities
+        self.members = dict([(k, table.ids[order[starts[k]:ends[k]]].tolist()) for k in range(len(classes))])
+
+        # Each class takes the levels of its first member and the mean numerical values of its members
+        self.data = EntityTable(range(len(classes)),
+                                dict([(v, numpy.bincount(label, table.columns[v], len(classes)) / size)
+                                      for v in numerical_variables]),
+                                dict([(c, (table.codes[c][order[starts]], table.levels[c]))
+                                      for c in categorical_variables]))
+
+        self.level_index = dict([(c, self.data.get_level_index(c)) for c in categorical_variables])
+
+        self.categorical = model_data.categorical
+
+        self.numerical = model_data.numerical
+
+        return